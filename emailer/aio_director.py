@@ -0,0 +1,217 @@
+"""
+asyncio flavour of EmailDirector (Python 3 only).
+
+Rendering and database work stay blocking and run inside an executor,
+provider calls go through a pluggable transport, so payload rendering
+of one job overlaps with network waits of others.
+"""
+import json
+import asyncio
+import functools
+import collections
+from urllib.parse import urlsplit
+
+import mandrill
+
+from lib.logger import Logger
+from email_director import EmailDirector
+from writer import results
+from providers import providers
+from dbpool import pool, Pooled
+from suppression import Suppressed, SUPPRESSED_STATUS
+from ratelimit import limiter
+
+
+logger = Logger(__name__)
+
+
+class Transport(object):
+    """
+    Provider transport interface.
+    `send` returns a list of per-recipient results as Mandrill does.
+    """
+    async def send(self, api_key, message, ip_pool):
+        raise NotImplementedError
+
+
+class MandrillTransport(Transport):
+    """
+    Official (blocking) Mandrill client, borrowed from `providers`
+    and executed in the loop's executor.
+    """
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    async def send(self, api_key, message, ip_pool):
+        _call = functools.partial(self._send, api_key, message, ip_pool)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, _call)
+
+    @staticmethod
+    def _send(api_key, message, ip_pool):
+        with providers.borrow(api_key) as client:
+            return client.messages.send(message=message, ip_pool=ip_pool, **{'async': False})
+
+
+class HTTPTransport(Transport):
+    """
+    Non-blocking JSON-over-HTTP transport speaking the Mandrill API.
+    `base_url` may point to a local stand-in server for tests.
+    """
+    def __init__(self, base_url='https://mandrillapp.com/api/1.0/', timeout=30):
+        self.base_url, self.timeout = base_url.rstrip('/') + '/', timeout
+
+    async def send(self, api_key, message, ip_pool):
+        _body = dict(key=api_key, message=message, ip_pool=ip_pool, **{'async': False})
+        status, payload = await asyncio.wait_for(
+            self._post('messages/send.json', _body), self.timeout)
+        if status != 200:
+            _e = (status == 503 and mandrill.ServiceUnavailableError or mandrill.Error)(
+                '%s: %s' % (status, payload))
+            _e.status = status
+            raise _e
+        return payload
+
+    async def _post(self, path, body):
+        _u = urlsplit(self.base_url + path)
+        _tls = _u.scheme == 'https'
+        reader, writer = await asyncio.open_connection(
+            _u.hostname, _u.port or (_tls and 443 or 80), ssl=_tls or None)
+        data = json.dumps(body).encode('utf-8')
+        _head = '\r\n'.join((
+            'POST %s HTTP/1.0' % _u.path,
+            'Host: %s' % _u.netloc,
+            'Content-Type: application/json',
+            'Content-Length: %d' % len(data),
+            'Connection: close', '', ''))
+        try:
+            writer.write(_head.encode('latin-1') + data)
+            await writer.drain()
+            raw = await reader.read()
+        finally:
+            writer.close()
+        head, _, payload = raw.partition(b'\r\n\r\n')
+        status = int(head.split(None, 2)[1])
+        return status, json.loads(payload.decode('utf-8') or 'null')
+
+
+class AsyncEmailDirector(EmailDirector):
+    """
+    Same prepare_email -> send_email -> update_mail_job lifecycle,
+    exposed as awaitables.
+    """
+    def __init__(self, engine, *args, **kwargs):
+        super(AsyncEmailDirector, self).__init__(*args, **kwargs)
+        self.engine = engine
+
+    def _blocking(self, func, *args):
+        _call = functools.partial(self._bound, func, *args)
+        return asyncio.get_event_loop().run_in_executor(self.engine.executor, _call)
+
+    def _bound(self, func, *args):
+        # connection is leased for this call only, never held across awaits;
+        # Pooled objects built by earlier calls (i.e. Mail) share it meanwhile
+        with pool.lease() as conn:
+            _shared = [self] + [_a for _a in args if isinstance(_a, Pooled)]
+            for _o in _shared:
+                _o.conn = conn
+            try:
+                return func(*args)
+            finally:
+                for _o in _shared:
+                    _o.conn = None
+
+    @classmethod
+    def new(cls, engine, *job):
+        """
+        Build a director in an executor thread and give its pooled
+        connection straight back, every later call leases its own.
+        """
+        director = cls(engine, *job)
+        director.close()
+        return director
+
+    async def __call__(self):
+        logger.info('Mail Type: %s' % self.mail_type)
+        Mail = await self.aprepare_email()
+        try:
+            await self.asend_email(*Mail.mailjob)
+        except Suppressed as e:
+            logger.info(e)
+            await self.aupdate_mail_job(Mail, SUPPRESSED_STATUS)
+            return False
+        await self.aupdate_mail_job(Mail)
+        return True
+
+    def aprepare_email(self):
+        return self._blocking(self.prepare_email)
+
+    async def asend_email(self, recipient, mail):
+        api_key, message = await self._blocking(self.compose, recipient, mail)
+        # may start a suppression list reload: off the loop
+        await self._blocking(self.check_recipient, recipient, api_key)
+        _wait = limiter.reserve(api_key, self.ip_pool)
+        try:
+            await asyncio.sleep(_wait)
+        finally:
+            limiter.done(_wait)
+        async with self.engine.slot(api_key, self.ip_pool):
+            try:
+                _r = await self.engine.transport.send(api_key, message, self.ip_pool)
+            except mandrill.Error as e:
+                limiter.feedback(api_key, self.ip_pool, error=e)
+                logger.error('A Mandrill error occured: %s - %s' % (e.__class__, e))
+                raise
+        limiter.feedback(api_key, self.ip_pool, response=_r)
+        # may flush buffered results
+        await self._blocking(self._keep_communication, _r, None, api_key)
+        logger.info('Mail successfully sent to %s.' % recipient)
+        return True
+
+    def aupdate_mail_job(self, obj, *args):
+        return self._blocking(self.update_mail_job, obj, *args)
+
+
+class AsyncEngine(object):
+    """
+    Runs many AsyncEmailDirectors, keeping at most `concurrency`
+    provider calls in flight per (api_key, ip_pool) and at most `max_jobs`
+    jobs (directors) alive at once.
+    """
+    def __init__(self, transport=None, concurrency=8, executor=None, max_jobs=64):
+        self.transport = transport or MandrillTransport(executor)
+        self.executor = executor
+        self.concurrency, self.max_jobs = concurrency, max_jobs
+        self._slots = collections.defaultdict(
+            lambda: asyncio.Semaphore(self.concurrency))
+
+    def slot(self, api_key, ip_pool):
+        return self._slots[api_key, ip_pool]
+
+    async def _run(self, job):
+        _new = functools.partial(AsyncEmailDirector.new, self, *job)
+        director = None
+        try:
+            director = await asyncio.get_event_loop().run_in_executor(self.executor, _new)
+            return await director()
+        except Exception as e:
+            logger.error('Mail job #%s failed: %s' % (job[0], e))
+            return False
+        finally:
+            if director is not None:
+                director.close()
+
+    async def run(self, jobs):
+        """
+        Process (mail_job_id, event_id, extra_param, mail_type) tuples.
+        Returns {mail_job_id: True|False}.
+        """
+        jobs, _cap = list(jobs), asyncio.Semaphore(self.max_jobs)
+
+        async def _capped(job):
+            async with _cap:
+                return await self._run(job)
+        try:
+            done = await asyncio.gather(*map(_capped, jobs))
+        finally:
+            results.flush()
+        return {_j[0]: _d for _j, _d in zip(jobs, done)}
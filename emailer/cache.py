@@ -0,0 +1,102 @@
+import time
+import threading
+import collections
+
+import settings
+
+
+class TTLCache(object):
+    """
+    Size-bounded LRU cache with per-entry time to live.
+    Shared between director and email instances of a process,
+    so every mail job would not pay for the same SELECT again.
+    """
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl, self.maxsize = ttl, maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._d = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._d.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                self.misses += 1
+                return default
+            # re-insert: most recently used goes last
+            self._d[key] = expires, value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._d.pop(key, None)
+            self._d[key] = time.time() + self.ttl, value
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def fetch(self, key, loader, *args):
+        """
+        Return cached value or call `loader(*args)` and remember its result.
+        """
+        value = self.get(key, self)
+        if value is self:
+            value = self.set(key, loader(*args))
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Drop single key, or everything if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._d.clear()
+            else:
+                self._d.pop(key, None)
+
+    def purge(self, match):
+        """
+        Drop every entry whose value satisfies `match(value)`,
+        i.e. all rows of a client which has just been updated.
+        """
+        with self._lock:
+            for _k in [_k for _k, (_, _v) in self._d.items() if match(_v)]:
+                del self._d[_k]
+
+    def stats(self):
+        _total = self.hits + self.misses
+        return dict(
+            size=len(self._d), maxsize=self.maxsize, ttl=self.ttl,
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+            ratio=_total and float(self.hits) / _total or 0.0)
+
+
+# client rows, keyed by ('event', event_id) or ('key', client_key)
+clients = TTLCache(
+    ttl=getattr(settings, 'CLIENT_CACHE_TTL', 300),
+    maxsize=getattr(settings, 'CLIENT_CACHE_SIZE', 1024))
+
+# parsed reply-address tables, keyed by (client_id, raw MTA configuration)
+senders = TTLCache(
+    ttl=getattr(settings, 'CLIENT_CACHE_TTL', 300),
+    maxsize=getattr(settings, 'CLIENT_CACHE_SIZE', 1024))
+
+
+def invalidate_client(client_id):
+    """
+    Forget cached rows of a client (after its configuration has changed).
+    """
+    clients.purge(lambda _r: _r['id'] == client_id)
+    senders.invalidate()
@@ -0,0 +1,308 @@
+import time
+import threading
+import contextlib
+
+from lib import db
+from lib.logger import Logger
+import settings
+
+
+logger = Logger(__name__)
+
+# marks SQL that must never be PREPAREd (i.e. generated, one-off texts)
+NO_PREPARE = '/* no prepare */'
+
+
+class Statements(object):
+    """
+    Server-side prepared statements, per connection and keyed by SQL text.
+    Statement is PREPAREd on first use and EXECUTEd ever after;
+    anything that can not be prepared (IN %s with a tuple, named or no
+    parameters, multiple statements, more than `max_args` parameters,
+    SQL marked with NO_PREPARE, ...) is executed as is.
+    """
+    verbs = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+    prepares = executes = fallbacks = failures = 0
+    _lock = threading.Lock()
+
+    def __init__(self, conn, limit=256, max_args=32):
+        self.conn, self.limit, self.max_args = conn, limit, max_args
+        self.names, self.skip = {}, set()
+
+    @classmethod
+    def count(cls, counter):
+        with cls._lock:
+            setattr(cls, counter, getattr(cls, counter) + 1)
+
+    @classmethod
+    def stats(cls):
+        return dict(
+            prepares=cls.prepares, executes=cls.executes,
+            fallbacks=cls.fallbacks, failures=cls.failures)
+
+    def preparable(self, sql, args):
+        if sql in self.skip or not args or not isinstance(args, (tuple, list)):
+            return False
+        if len(args) > self.max_args or NO_PREPARE in sql:
+            return False
+        if any(isinstance(_a, (tuple, list, dict, set)) for _a in args):
+            return False
+        _body = sql.strip().rstrip(';').strip()
+        if ';' in _body or _body.split(None, 1)[0].upper() not in self.verbs:
+            return False
+        return _body.replace('%%', '').count('%') == _body.count('%s') == len(args)
+
+    def execute(self, cursor, sql, args):
+        name = self.names.get(sql)
+        if name is None:
+            if len(self.names) >= self.limit or not self.preparable(sql, args):
+                self.count('fallbacks')
+                return cursor.execute(sql, args)
+            name = self.prepare(cursor, sql)
+            if name is None:
+                self.count('fallbacks')
+                return cursor.execute(sql, args)
+        self.count('executes')
+        return cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))), args)
+
+    def prepare(self, cursor, sql):
+        _parts = sql.strip().rstrip(';').replace('%%', '\0').split('%s')
+        _body = ''.join(
+            _p + (_i < len(_parts) - 1 and '$%d' % (_i + 1) or '')
+            for _i, _p in enumerate(_parts)).replace('\0', '%')
+        name = 'emailer_%d' % (len(self.names) + 1)
+        _safe = not getattr(self.conn, 'autocommit', False)
+        try:
+            if _safe:
+                cursor.execute('SAVEPOINT emailer_prepare')
+            cursor.execute('PREPARE %s AS %s' % (name, _body))
+            if _safe:
+                cursor.execute('RELEASE SAVEPOINT emailer_prepare')
+        except Exception as e:
+            logger.debug('Statement was not prepared: %s' % e)
+            if _safe:
+                cursor.execute('ROLLBACK TO SAVEPOINT emailer_prepare')
+            self.skip.add(sql)
+            self.count('failures')
+            return None
+        self.count('prepares')
+        self.names[sql] = name
+        return name
+
+
+class PreparingCursor(object):
+    """
+    DB-API cursor proxy routing `execute` through connection's Statements.
+    """
+    def __init__(self, cursor, statements):
+        self._cursor, self._statements = cursor, statements
+
+    __getattr__ = lambda s, item: getattr(s._cursor, item)
+    __iter__ = lambda s: iter(s._cursor)
+    __enter__ = lambda s: s
+    __exit__ = lambda s, *exc: s._cursor.close()
+
+    def execute(self, sql, args=None):
+        return self._statements.execute(self._cursor, sql, args)
+
+
+class PreparingConnection(object):
+    """
+    DB-API connection proxy handing out PreparingCursors.
+    """
+    def __init__(self, conn):
+        self._conn, self.statements = conn, Statements(conn)
+
+    __getattr__ = lambda s, item: getattr(s._conn, item)
+    __enter__ = lambda s: s._conn.__enter__() and s
+    __exit__ = lambda s, *exc: s._conn.__exit__(*exc)
+
+    def cursor(self, *args, **kwargs):
+        return PreparingCursor(self._conn.cursor(*args, **kwargs), self.statements)
+
+
+def _connect():
+    """
+    Open a connection the way lib.db.DB does it,
+    wrapped for prepared statements unless disabled in settings.
+    """
+    _db = db.DB.__new__(db.DB)
+    db.DB.connect(_db)
+    if not getattr(settings, 'DB_PREPARE_STATEMENTS', True):
+        return _db.conn
+    return PreparingConnection(_db.conn)
+
+
+class ConnectionPool(object):
+    """
+    Process-wide pool of database connections.
+
+    A connection is leased to a thread (re-entrant, reference counted),
+    so the director and every Email it builds for a job share one connection.
+    Connections come back rolled back (unless in autocommit), so no job gets
+    another one's open or aborted transaction; connections idle longer than
+    `check_after` seconds are health-checked before they are handed out again.
+    """
+    def __init__(self, connect=_connect, size=8, check_after=30, timeout=30):
+        self.connect, self.size = connect, size
+        self.check_after, self.timeout = check_after, timeout
+        self.created = self.checkouts = self.replaced = self.waits = 0
+        self.checkout_time = self.max_checkout_time = 0.0
+        self._idle, self._out = [], 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def checkout(self):
+        started = time.time()
+        with self._cond:
+            while not self._idle and self._out >= self.size:
+                self.waits += 1
+                if not self._cond.wait(self.timeout) and not self._idle and self._out >= self.size:
+                    raise RuntimeError('No database connection available in %ss' % self.timeout)
+            self._out += 1
+            _idle = self._idle and self._idle.pop() or None
+        try:
+            conn = _idle and self._healthy(*_idle)
+            if conn is None:
+                conn = self.connect()
+                self.created += 1
+        except Exception:
+            self.checkin(None, broken=True)
+            raise
+        _t = time.time() - started
+        with self._cond:
+            self.checkouts += 1
+            self.checkout_time += _t
+            self.max_checkout_time = max(self.max_checkout_time, _t)
+        return conn
+
+    def checkin(self, conn, broken=False):
+        if not broken and conn is not None and not self._rollback(conn):
+            broken = True
+        with self._cond:
+            self._out -= 1
+            if not broken:
+                self._idle.append((time.time(), conn))
+            self._cond.notify()
+        if broken and conn is not None:
+            self._close(conn)
+
+    def _rollback(self, conn):
+        """
+        End whatever transaction the job left open; False if the connection is unusable.
+        """
+        if getattr(conn, 'autocommit', False):
+            return True
+        # psycopg2: nothing to roll back when the connection is idle
+        _status = getattr(conn, 'get_transaction_status', None)
+        try:
+            if _status is None or _status() != 0:
+                conn.rollback()
+            return True
+        except Exception as e:
+            logger.debug('Pooled connection dropped: %s' % e)
+            self.replaced += 1
+            return False
+
+    def _healthy(self, released_at, conn):
+        if time.time() - released_at < self.check_after:
+            return conn
+        try:
+            _cur = conn.cursor()
+            _cur.execute('SELECT 1')
+            _cur.fetchall()
+            return conn
+        except Exception as e:
+            logger.debug('Pooled connection dropped: %s' % e)
+            self.replaced += 1
+            self._close(conn)
+            return None
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def current(self):
+        """
+        Connection leased to the current thread, if any.
+        """
+        return getattr(self._local, 'conn', None)
+
+    def acquire(self):
+        """
+        Lease a connection to the current thread; pair with `release`.
+        """
+        _l = self._local
+        if not getattr(_l, 'refs', 0):
+            _l.conn, _l.refs = self.checkout(), 0
+        _l.refs += 1
+        return _l.conn
+
+    def release(self, conn=None, broken=False):
+        _l = self._local
+        if conn is not None and conn is not getattr(_l, 'conn', None):
+            # leased in another thread
+            return self.checkin(conn, broken)
+        _l.refs -= 1
+        if _l.refs <= 0 or broken:
+            conn, _l.conn, _l.refs = _l.conn, None, 0
+            self.checkin(conn, broken)
+
+    def reset(self):
+        """
+        Forget connections inherited from the parent process (after fork).
+        They are not closed: their sockets still belong to the parent.
+        """
+        self._idle, self._out = [], 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def lease(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                size=self.size, idle=len(self._idle), out=self._out,
+                created=self.created, replaced=self.replaced, waits=self.waits,
+                checkouts=self.checkouts, max_checkout_time=self.max_checkout_time,
+                avg_checkout_time=self.checkouts and self.checkout_time / self.checkouts or 0.0)
+
+
+pool = ConnectionPool(
+    size=getattr(settings, 'DB_POOL_SIZE', 8),
+    check_after=getattr(settings, 'DB_POOL_CHECK_AFTER', 30))
+
+
+class Pooled(object):
+    """
+    Mixin for lib.db.DB subclasses: `connect` borrows the connection
+    leased to the current thread instead of opening a new one.
+    The first object to connect owns the lease and must `close` it
+    once the job is done; objects built meanwhile just share it.
+    """
+    conn, _owner = None, False
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = pool.current()
+            if self.conn is None:
+                self.conn, self._owner = pool.acquire(), True
+        return self.conn
+
+    def close(self):
+        if self._owner:
+            pool.release(self.conn)
+        self.conn, self._owner = None, False
+
+
+class PooledDB(Pooled, db.DB):
+    pass
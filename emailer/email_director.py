@@ -1,11 +1,21 @@
 import mandrill
 import ast
 import json
-import random
+import hashlib
 import itertools
+import collections
 
 from lib import db
 from lib.logger import Logger
+from cache import clients, senders
+from writer import results
+from providers import providers
+from registry import MailTypeRegistry
+from metrics import metrics
+from prefetch import Prefetch
+from ratelimit import limiter
+from dbpool import Pooled
+from suppression import suppressed, Suppressed, SUPPRESSED_STATUS
 import email_type
 import settings
 
@@ -38,23 +48,35 @@ class MailTypeDescriptor(object):
         return self.iterable.get(_v)
 
 
-class EmailDirector(db.DB):
+class EmailDirector(Pooled, db.DB):
     """
     Director class which decides which class to instantiate for the email type.
     It is also responsible for sending out the emails once build.
     """
-    _iterator = {_c.dbkey(): _c for _c in email_type.Email.__subclasses__()}
+    _iterator = MailTypeRegistry(
+        email_type.Email, snapshot=getattr(settings, 'MAIL_TYPE_SNAPSHOT', None))
     mail_type = MailTypeDescriptor(name='mail_type', iterable=_iterator)
-    prepare_email = lambda s: s.mail_type(dict(client=s.client, **s.job)).build_email()
+    ip_pool = '...'
+    spool = None    # spool.Spool, when payloads are delivered by a Drainer
+    merge_tags = False  # per-recipient values as Mandrill merge vars (batched sends)
+    prepare_email = lambda s: s.mail_type(dict(
+        client=s.client, prefetched=s.prefetched, merge_tags=s.merge_tags, **s.job)).build_email()
     __getattr__ = lambda self, item: getattr(self.mail_type, item)
 
     def __init__(self, mail_job_id, event_id, extra_param, mail_type, *args, **kwargs):
-        self.job = locals()
+        # job snapshot without `self`: Email objects must not keep the director alive
+        self.job = {_k: _v for _k, _v in locals().items() if _k != 'self'}
         super(__class__, self).__init__()
-        self.mail_type = mail_type
+        try:
+            self.mail_type = mail_type
+        except Exception:
+            # nobody else will give the pooled connection back
+            self.close()
+            raise
         self.event_id = event_id
         self.job_id = mail_job_id
         self.params, self.submid = [], []
+        self.prefetched = None
 
     def __call__(self):
         """
@@ -62,57 +84,215 @@ class EmailDirector(db.DB):
         Executed from email scheduler.
         """
         logger.info('Mail Type: %s' % self.mail_type)
-        Mail = self.prepare_email()
-        self.send_email(*Mail.mailjob)
-        self.update_mail_job(Mail)
+        try:
+            Mail = self.prepare_email()
+            try:
+                if self.spool is not None:
+                    return self.spool_email(Mail)
+                self.send_email(*Mail.mailjob)
+            except Suppressed as e:
+                logger.info(e)
+                status = SUPPRESSED_STATUS
+            else:
+                status = settings.JOB_STATUS['...']
+            self.update_mail_job(Mail, status)
+        finally:
+            # give pooled connection back
+            self.close()
+
+    def spool_email(self, Mail):
+        """
+        Hand rendered payload over to the spool.
+        Sending, `_keep_communication` and `update_mail_job` are done by its Drainer.
+        """
+        api_key, message = self.compose(*Mail.mailjob)
+        self.check_recipient(Mail.mailjob[0], api_key)
+        _job = tuple(self.job[_k] for _k in ('mail_job_id', 'event_id', 'extra_param', 'mail_type'))
+        _id = self.spool.append(_job, api_key, message, Mail.submid)
+        logger.info('Mail for %s spooled (#%s).' % (Mail.mailjob[0], _id))
+        return True
+
+    def revive(self, submid):
+        """
+        Email instance of a job rendered earlier, good enough for status updates.
+        """
+        Mail = self.mail_type(dict(client=self.client, **self.job))
+        Mail.submid = submid
+        return Mail
+
+    @classmethod
+    def batch(cls, jobs):
+        """
+        Batched entrance.
+        Takes an iterable of (mail_job_id, event_id, extra_param, mail_type) tuples,
+        groups rendered emails by client and api key, and submits identical
+        payloads (everything but the recipient and its merge vars) within
+        a single provider call.
+        Returns {mail_job_id: True|False}.
+        """
+        try:
+            return cls._batch(jobs)
+        finally:
+            results.flush()
+
+    @classmethod
+    def _batch(cls, jobs):
+        directors, done = [], {}
+        try:
+            for _job in jobs:
+                try:
+                    directors.append(cls(*_job))
+                except Exception as e:
+                    logger.error('Mail job #%s was not started: %s' % (_job[0], e))
+                    done[_job[0]] = False
+            done.update(directors and cls._send_batch(directors) or {})
+            return done
+        finally:
+            for director in directors:
+                director.close()
+
+    @classmethod
+    def _send_batch(cls, directors):
+        groups, done, seen = collections.OrderedDict(), {}, collections.defaultdict(set)
+        try:
+            shared = Prefetch(directors[0]).load(directors)
+        except Exception as e:
+            # jobs fall back to fetching their own rows
+            logger.error('Prefetch failed: %s' % e)
+            shared = None
+        for director in directors:
+            director.prefetched, director.merge_tags = shared, True
+            try:
+                Mail = director.prepare_email()
+                api_key, message = director.compose(*Mail.mailjob)
+                director.check_recipient(Mail.mailjob[0], api_key)
+            except Suppressed as e:
+                logger.info(e)
+                director.update_mail_job(Mail, SUPPRESSED_STATUS)
+                done[director.job_id] = False
+                continue
+            except Exception as e:
+                logger.error('Mail job #%s was not prepared: %s' % (director.job_id, e))
+                done[director.job_id] = False
+                continue
+            # a recipient appears once per provider call: results map back by address
+            _email, _n = suppressed.normalize(message['to'][0]['email']), 0
+            _base = director.client['id'], api_key, cls._fingerprint(message)
+            while _email in seen[_base + (_n,)]:
+                _n += 1
+            _key = _base + (_n,)
+            seen[_key].add(_email)
+            groups.setdefault(_key, []).append((director, Mail, message))
+
+        for (_, api_key, _, _), group in groups.items():
+            _jobs = {suppressed.normalize(_m['to'][0]['email']): _d.job_id for _d, _, _m in group}
+            message = dict(group[0][2], preserve_recipients=False, to=[
+                _m['to'][0] for _, _, _m in group])
+            _vars = [_v for _, _, _m in group for _v in _m.get('merge_vars', ())]
+            if _vars:
+                message['merge_vars'] = _vars
+            try:
+                group[0][0].mandrill(api_key=api_key, datablock=message, jobs=_jobs)
+            except mandrill.Error:
+                done.update({_d.job_id: False for _d, _, _ in group})
+                continue
+            logger.info('Mail successfully sent to %d recipients.' % len(group))
+            cls.update_mail_jobs([_g[:2] for _g in group])
+            done.update({_d.job_id: True for _d, _, _ in group})
+        return done
+
+    @staticmethod
+    def _fingerprint(message):
+        """
+        Digest of a message payload without its recipients (and their merge vars).
+        """
+        _body = {_k: _v for _k, _v in message.items() if _k not in ('to', 'merge_vars')}
+        _s = json.dumps(_body, sort_keys=True, default=str)
+        return hashlib.md5(_s.encode('utf-8')).hexdigest()
 
     @property
     def client(self):
         """
-        Get client (not end-user) details from specific event
+        Get client (not end-user) details from specific event.
+        Row is shared through `cache.clients` for its time to live.
         """
+        return clients.fetch(('event', self.event_id), self._fetch_client)
+
+    def _fetch_client(self):
         sql = '''
             SELECT ...
         ;'''
-        _r = self.select_one(sql, (self.event_id,), True)
+        with metrics.stage('client', self.mail_type):
+            _r = self.select_one(sql, (self.event_id,), True)
         assert _r, 'No client found for event #%s' % self.event_id
         return dict(_r)
 
-    def _keep_communication(self, r):
+    def _keep_communication(self, r, jobs=None, api_key=None):
         """
         self.job_id, _r['email'], _r['status'], _r.get('reject_reason', ''), _r['_id']
+        In batched mode, `jobs` maps recipient email (normalized) to its mail job id.
+        Rows are buffered by `writer.results` and written in bulk.
         """
         # logger.debug(r)
-        for _d in r:
-            sql = '''
-                INSERT into ...
-            ;'''
-            _args = self.job_id, _d['email'], _d['status'], _d.get('reject_reason', ''), _d['_id']
-            self.insert(sql, _args)
+        jobs, r = jobs or {}, list(r)
+        suppressed.observe(r, api_key)
+        with metrics.stage('keep_communication', self.mail_type):
+            results.add([(
+                jobs.get(suppressed.normalize(_d['email']), self.job_id),
+                _d['email'], _d['status'], _d.get('reject_reason', ''), _d['_id']) for _d in r])
 
     def _sent_from(self):
         """
         Find out who should be ready to listen to user replies.
         Client must define dictionary
+        Parsed tables are shared through `cache.senders`, keyed by client id
+        and the raw configuration, so a changed client row is parsed again.
         """
-        _mta = self.client.get('...key...')
+        client = self.client
+        _mta = client.get('...key...')
         _m = 'Reply address for %s (ID #%s) for %s (ID #%s) was not found.'
         try:
-            _key= random.choice(xrange(2)) and self.dbkey() or self.mail_type.dbkey()  # same
-            adb = _mta and ast.literal_eval(json.loads(_mta)) or settings.FROM_ADDR
-            _d = adb.get('%s' % _key) or adb.get(_key)
-            assert _d, _m % (self.mail_type, _key, self.client['name'], self.client['id'])
+            _key = self._iterator.key(self.mail_type)
+            table = senders.fetch((client['id'], _mta), self._sender_table, _mta)
+            _d = table.get(_key)
+            assert _d, _m % (self.mail_type, _key, client['name'], client['id'])
         except AssertionError as e:
             logger.debug(e)
             _d = dict(from_email='...@.......',
                       from_name='... ...')
         return _d
 
+    def _sender_table(self, mta):
+        """
+        {mail type id: sender dict} for every known mail type.
+        """
+        adb = mta and ast.literal_eval(json.loads(mta)) or settings.FROM_ADDR
+        return {_k: adb.get('%s' % _k) or adb.get(_k) for _k in self._iterator}
+
     def send_email(self, recipient, mail):
         """
-        Email template prepared and ready to be sent out,
+        Email template prepared and ready to be sent out.
+        """
+        api_key, message = self.compose(recipient, mail)
+        self.check_recipient(recipient, api_key)
+        self.mandrill(datablock=message, api_key=api_key)
+        logger.info('Mail successfully sent to %s.' % recipient)
+        return True
+
+    def check_recipient(self, recipient, api_key):
+        """
+        Raise Suppressed for addresses the provider account already rejected
+        or unsubscribers of this client.
+        """
+        if (api_key, self.client['id'], recipient) in suppressed:
+            raise Suppressed('%s is suppressed, mail will not be sent.' % recipient)
+
+    def compose(self, recipient, mail):
+        """
+        Build provider payload for a rendered email.
         If client has mailserver configured (boolean),
         extract values from config json.
+        Returns (api_key, message).
         """
         conf, _mc = {}, 'mailserver_configuration'
         mailserver_enabled = self.client[_mc]
@@ -134,25 +314,34 @@ class EmailDirector(db.DB):
         logger.info('Mail will be sent through %s mailserver configuration' % _cl)
 
         _msg_a = dict(auto_html=None, to=[{'email': recipient}])
+        if mail.get('merge_vars'):
+            # values for *|NAME|* tags rendered into the page
+            _msg_a.update(merge=True, merge_language='mailchimp', merge_vars=[{
+                'rcpt': recipient, 'vars': [
+                    {'name': _n.upper(), 'content': _v}
+                    for _n, _v in sorted(mail['merge_vars'].items())]}])
         _msg_b = {_k: mail[_k] for _k in ('text', 'html', 'subject')}
-        _msg_c = self._sent_from()
+        with metrics.stage('sent_from', self.mail_type):
+            _msg_c = self._sent_from()
         message = itertools.chain(*map(dict.items, (_msg_a, _msg_b, _msg_c)))
         MANDRILL_API_KEY = conf.get('...', {}).get('...')
-        self.mandrill(
-            datablock=dict(message),
-            api_key=MANDRILL_API_KEY or settings.MANDRILL_API_KEY)
-        logger.info('Mail successfully sent to %s.' % recipient)
-        return True
+        return MANDRILL_API_KEY or settings.MANDRILL_API_KEY, dict(message)
 
-    def mandrill(self, api_key, datablock):
+    def mandrill(self, api_key, datablock, jobs=None):
+        limiter.acquire(api_key, self.ip_pool, cost=len(datablock.get('to') or ()) or 1)
         try:
-            mandrill_client = mandrill.Mandrill(api_key)
-            _r = mandrill_client.messages.send(message=datablock, async=False, ip_pool='...')
+            with metrics.stage('send', self.mail_type):
+                with providers.borrow(api_key) as mandrill_client:
+                    # `async` is a reserved word since Python 3.7
+                    _r = mandrill_client.messages.send(
+                        message=datablock, ip_pool=self.ip_pool, **{'async': False})
         except mandrill.Error as e:
+            limiter.feedback(api_key, self.ip_pool, error=e)
             logger.error('A Mandrill error occured: %s - %s' % (e.__class__, e))
             raise
         else:
-            self._keep_communication(iter(_r))
+            limiter.feedback(api_key, self.ip_pool, response=_r)
+            self._keep_communication(iter(_r), jobs, api_key)
             return True
 
     def update_mail_job(self, obj, status=settings.JOB_STATUS['...']):
@@ -163,5 +352,23 @@ class EmailDirector(db.DB):
         sql = """
             UPDATE ...
         ;"""
-        self.update(sql, (status, self.job_id))
-        self.update_status(obj)
+        with metrics.stage('update_mail_job', self.mail_type):
+            self.update(sql, (status, self.job_id))
+            self.update_status(obj)
+
+    @classmethod
+    def update_mail_jobs(cls, done, status=settings.JOB_STATUS['...']):
+        """
+        Bulk version of `update_mail_job`,
+        takes a list of (director, Mail) pairs sharing the status.
+        """
+        if not done:
+            return
+        sql = """
+            UPDATE ...
+        ;"""
+        director = done[0][0]
+        with metrics.stage('update_mail_job', director.mail_type):
+            director.update(sql, (status, tuple(_d.job_id for _d, _ in done)))
+            for _d, Mail in done:
+                _d.update_status(Mail)
@@ -1,11 +1,13 @@
 import json
 import datetime
 import types
-import os
 
 from lib.db import DB
+from dbpool import Pooled
 from lib.logger import Logger
-from lib.template import Template
+from cache import clients
+from templates import templates
+from metrics import metrics
 import settings
 
 
@@ -45,14 +47,13 @@ class TemplateDescriptor(object):
         Look for template inside client folder.
             a) check if folder exists,
             b) does the file exist?
+        (both answered by `templates.locate`, memoized)
         Return string with a folder or empty string if not found.
         In addition, log failure.
         """
         client_id, def_client_id = (_c['...'] for _c in (
             instance.client, instance.default_client))
-        path = os.path.join(
-            settings.TEMPLATE_PATH, '%s' % client_id, template)
-        _tmpl_found = os.path.exists(path)
+        _tmpl_found = templates.locate(client_id, template)
         if not _tmpl_found and client_id != def_client_id:
             _stf = template, instance.client['name'], client_id
             _msg = "... wasn't found. Default template will be used."
@@ -60,7 +61,7 @@ class TemplateDescriptor(object):
         return _tmpl_found and '%s/' % client_id or ''
 
 
-class Email(DB):
+class Email(Pooled, DB):
     """
     Superclass for all email instances
     """
@@ -68,6 +69,8 @@ class Email(DB):
     email_template = TemplateDescriptor('email')
     subject_template = TemplateDescriptor('subject')
     _undefined = '#undefined'
+    # render shared part of a page once per event (see templates.Partial)
+    two_phase = getattr(settings, 'TWO_PHASE_RENDERING', False)
 
     @classmethod
     def dbkey(cls):
@@ -81,12 +84,29 @@ class Email(DB):
         # crime against humanity
         # instantiating just for getting an access to a method
         _d = {}.fromkeys(('...', '...'), None)
-        _r = cls(_d).select_one(sql, (cls._dbkeys[cls.__name__],))
+        _m = cls(_d)
+        try:
+            _r = _m.select_one(sql, (cls._dbkeys[cls.__name__],))
+        finally:
+            _m.close()
         if _r: return _r
         raise ValueError('... was not found' % cls.__name__)
 
+    @classmethod
+    def bulk_params(cls, db, jobs):
+        """
+        {key: params} for many jobs at once, used by `prefetch.Prefetch`.
+        Mail types without a bulk query return nothing
+        and keep fetching their params one by one.
+        """
+        return {}
+
     @property
     def default_client(self):
+        _key = 'key', settings.DEFAULT_CLIENT_KEY
+        return clients.fetch(_key, self._fetch_default_client)
+
+    def _fetch_default_client(self):
         sql = '''
             SELECT ...
         ;'''
@@ -100,7 +120,10 @@ class Email(DB):
         super(Email, self).__init__()
         self.job = job
         self.client = self.job.pop('...')
-        self.params, self.submid = [], []
+        self.prefetched = self.job.pop('prefetched', None)
+        # batched sends: recipient values go to the provider as merge vars
+        self.merge_tags = self.job.pop('merge_tags', False)
+        self.params, self.submid, self.merge_vars = [], [], None
         self.connect()
 
     def get_event_data(self):
@@ -111,9 +134,13 @@ class Email(DB):
             SELECT ...
         ;'''
         _a = self.job['...'],
-        _r = self.select(sql, _a)
-        assert _r, '... Aborting...' % _a
-        return json.loads(dict(_r[0]).get('...'))
+        _ed = self.prefetched and self.prefetched.event(_a[0])
+        if _ed is not None:
+            return _ed
+        with metrics.stage('event_data', self.__class__):
+            _r = self.select(sql, _a)
+            assert _r, '... Aborting...' % _a
+            return json.loads(dict(_r[0]).get('...'))
 
     def update_status(self, *args, **kwargs): pass
 
@@ -163,7 +190,7 @@ class Email(DB):
         return chr(32).join(event_name)
 
     def _build_subject(self, args={}):
-        template = Template(self.subject_template)
+        template = templates.get(self.subject_template)
         return template.render(args)
 
     def _get_params(self):
@@ -182,7 +209,20 @@ class ...(Email):
         self.email_template = '....html'
         self.subject_template = '....txt'
 
+    @classmethod
+    def bulk_params(cls, db, jobs):
+        sql = '''
+            SELECT ...
+            WHERE ... IN %s
+        ;'''
+        _keys = tuple(set(_j['...'] for _j in jobs))
+        _r = db.select(sql, (_keys, cls.event_participant_name_id))
+        return {_row['...']: dict(_row) for _row in _r or ()}
+
     def _get_params(self):
+        _p = self.prefetched and self.prefetched.param(self.__class__, self.job['...'])
+        if _p is not None:
+            return _p
         sql = '''
             SELECT ...
         ;'''
@@ -200,9 +240,10 @@ class ...(Email):
         return None
 
     def build_email(self):
-        self.params = self._get_params()
+        with metrics.stage('params', self.__class__):
+            self.params = self._get_params()
         self.ed = super(self.__class__, self).get_event_data()
-        template = Template(self.email_template)
+        template = templates.get(self.email_template)
 
         # holiday greeting: will affect ... and ...
         self.holiday_greeting = self.params.get('...') in self....
@@ -210,16 +251,31 @@ class ...(Email):
         self.submid = self.params['...']
         response_link = self._build_response_link()
 
-        html_page = template.render({'...': '...'
+        # event and client wide part of the page
+        shared = {
             'static_url': settings.STATIC_URL,
-            'response_link': response_link,
             'holiday': self.holiday_greeting,
+        }
+        # everything derived from recipient's params
+        slots = {'...': '...'
+            'response_link': response_link,
             'unsubscribe_url': self._build_unsubscribe_url(),
-        })
+        }
+        if self.merge_tags:
+            # page gets *|NAME|* tags, identical for every recipient of the event
+            self.merge_vars = slots
+            slots = {_n: '*|%s|*' % _n.upper() for _n in slots}
+        with metrics.stage('render', self.__class__):
+            if self.two_phase:
+                _key = self.job['...'], self.client['id'], self.email_template, self.holiday_greeting
+                html_page = templates.partial(_key, self.email_template, shared, slots)
+            else:
+                html_page = template.render(dict(shared, **slots))
         self.mailjob = self.params['...'], {
             'subject': subject,
             'html': html_page,
-            'text': "..." % dict(resp=response_link)}
+            'text': "..." % dict(resp=slots['response_link']),
+            'merge_vars': self.merge_vars}
         return self
 
     def _build_subject(self):
@@ -238,24 +294,38 @@ class ...(Email):
         self.email_template = '....html'
         self.subject_template = '....txt'
 
+    @classmethod
+    def bulk_params(cls, db, jobs):
+        sql = '''
+            SELECT ...
+            WHERE ... IN %s
+        ;'''
+        _r = db.select(sql, (tuple(set(_j['...'] for _j in jobs)),))
+        return {_row['...']: dict(_row) for _row in _r or ()}
+
     def _get_params(self):
         """
         ...
         """
+        _e = self.job['...'],
+        _p = self.prefetched and self.prefetched.param(self.__class__, _e[0])
+        if _p is not None:
+            return _p
         sql = '''
             SELECT ...
         ;'''
-        _e = self.job['...'],
         _r = self.select(sql, _e)
         assert _r, "... not found ..." % _e
         return dict(_r[0])
 
     def build_email(self):
-        self.params = self._get_params()
+        with metrics.stage('params', self.__class__):
+            self.params = self._get_params()
         self.event_data = super(self.__class__, self).get_event_data()
-        template = Template(self.email_template)
+        template = templates.get(self.email_template)
         gateway = "..." in self.params['...'] and '...' or '...'
-        email_body = template.render({'...': '...'})
+        with metrics.stage('render', self.__class__):
+            email_body = template.render({'...': '...'})
         self.mailjob = '...@.......', {
             'subject': self._build_subject({'...': self.params['...']}),
             'html': email_body,
@@ -0,0 +1,279 @@
+"""
+Record-and-replay load harness for EmailDirector.
+
+Record (on a worker with real database):
+    recorder = Recorder('run.jsonl').install()
+    ... EmailDirector jobs as usual, built from recorder.director ...
+    recorder.close()
+
+Replay (anywhere, no database or provider needed):
+    python loadtest.py run.jsonl --speed 5 --latency 0.2 --errors 0.01
+
+The send rate limiter is lifted during replay (`--rate` sets one), so the
+harness measures the code rather than the configured msg/sec; latencies
+run from each job's scheduled time, so queueing under overload shows up.
+"""
+import json
+import time
+import uuid
+import random
+import sqlite3
+import argparse
+import threading
+from concurrent import futures
+
+import mandrill
+
+from dbpool import pool
+from providers import providers
+from ratelimit import limiter
+from metrics import metrics
+from writer import results
+from email_director import EmailDirector
+
+
+class Row(tuple):
+    """
+    Replayed row, accessible by index and by column name (as DictRow).
+    """
+    def __new__(cls, columns, values):
+        _r = super(Row, cls).__new__(cls, values)
+        _r._columns = columns
+        return _r
+
+    keys = lambda s: list(s._columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        return tuple.__getitem__(self, self._columns.index(key))
+
+
+class _RecordingCursor(object):
+    def __init__(self, cursor, recorder):
+        self._cursor, self._recorder, self._sql = cursor, recorder, None
+
+    __getattr__ = lambda s, item: getattr(s._cursor, item)
+    __iter__ = lambda s: iter(s.fetchall())
+
+    def execute(self, sql, args=None):
+        self._sql = sql, args
+        return self._cursor.execute(sql, args)
+
+    def _columns(self):
+        return [_d[0] for _d in self._cursor.description or ()]
+
+    def fetchone(self):
+        _r = self._cursor.fetchone()
+        self._recorder.query(self._sql, self._columns(), _r is not None and [_r] or [])
+        return _r
+
+    def fetchall(self):
+        _r = self._cursor.fetchall()
+        self._recorder.query(self._sql, self._columns(), _r)
+        return _r
+
+
+class _RecordingConnection(object):
+    def __init__(self, conn, recorder):
+        self._conn, self._recorder = conn, recorder
+
+    __getattr__ = lambda s, item: getattr(s._conn, item)
+
+    def cursor(self, *args, **kwargs):
+        return _RecordingCursor(self._conn.cursor(*args, **kwargs), self._recorder)
+
+
+class Recorder(object):
+    """
+    Captures job tuples (with their start offsets) and every row they read
+    into a JSON-lines file.
+    """
+    def __init__(self, path):
+        self.path, self.started = path, time.time()
+        self._f, self._lock = open(path, 'w'), threading.Lock()
+        self._seen = set()
+
+    def _write(self, record):
+        with self._lock:
+            self._f.write(json.dumps(record, default=str) + '\n')
+
+    def install(self):
+        _connect = pool.connect
+        pool.connect = lambda: _RecordingConnection(_connect(), self)
+        recorder = self
+
+        class RecordingDirector(EmailDirector):
+            def __init__(self, *job, **kwargs):
+                recorder.job(job)
+                super(RecordingDirector, self).__init__(*job, **kwargs)
+        self.director = RecordingDirector
+        return self
+
+    def job(self, job):
+        self._write(dict(t=time.time() - self.started, job=list(job)))
+
+    def query(self, statement, columns, rows):
+        if statement is None:
+            return
+        sql, args = statement
+        _key = sql, json.dumps(args, default=str)
+        if _key in self._seen:
+            return
+        self._seen.add(_key)
+        self._write(dict(sql=sql, args=_key[1], columns=columns, rows=[list(_r) for _r in rows]))
+
+    def close(self):
+        self._f.close()
+
+
+class ReplayStore(object):
+    """
+    SQLite stand-in for the database: answers recorded (sql, args) with
+    recorded rows, writes are accepted and counted.
+    """
+    def __init__(self, records):
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute('CREATE TABLE rows (sql TEXT, args TEXT, columns TEXT, data TEXT, '
+                         'PRIMARY KEY (sql, args))')
+        self._db.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)', (
+            (_r['sql'], _r['args'], json.dumps(_r['columns']), json.dumps(_r['rows']))
+            for _r in records))
+        self._lock = threading.Lock()
+        self.reads = self.writes = self.misses = 0
+
+    def lookup(self, sql, args):
+        with self._lock:
+            _r = self._db.execute(
+                'SELECT columns, data FROM rows WHERE sql = ? AND args = ?',
+                (sql, json.dumps(args, default=str))).fetchone()
+        if _r is None:
+            self.misses += 1
+            return []
+        self.reads += 1
+        columns = json.loads(_r[0])
+        return [Row(columns, _v) for _v in json.loads(_r[1])]
+
+    def connect(self):
+        return _ReplayConnection(self)
+
+
+class _ReplayCursor(object):
+    def __init__(self, store):
+        self.store, self._rows, self.description = store, [], None
+        self.rowcount = -1
+
+    def execute(self, sql, args=None):
+        if sql.lstrip().split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            self.store.writes += 1
+            self._rows = []
+        else:
+            self._rows = self.store.lookup(sql, args)
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows and self._rows.pop(0) or None
+
+    def fetchall(self):
+        _r, self._rows = self._rows, []
+        return _r
+
+    __iter__ = lambda s: iter(s.fetchall())
+    close = lambda s: None
+
+
+class _ReplayConnection(object):
+    autocommit = True
+
+    def __init__(self, store):
+        self.store = store
+
+    cursor = lambda s, *a, **kw: _ReplayCursor(s.store)
+    commit = rollback = close = lambda s: None
+
+
+class FakeMandrill(object):
+    """
+    Provider stand-in with configurable latency (seconds) and error rate.
+    """
+    def __init__(self, api_key, latency=0.1, jitter=0.05, errors=0.0):
+        self.latency, self.jitter, self.errors = latency, jitter, errors
+        self.messages = self
+
+    def send(self, message, ip_pool=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.errors:
+            raise mandrill.Error('Simulated provider error')
+        return [dict(email=_t['email'], status='sent', _id=uuid.uuid4().hex)
+                for _t in message.get('to', ())]
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def replay(path, speed=1.0, workers=8, latency=0.1, jitter=0.05, errors=0.0, rate=None):
+    """
+    Replays recorded jobs at `speed` times the recorded rate,
+    sends limited to `rate` msg/sec per account (None: unlimited).
+    Returns report dict: jobs/sec, per-stage p50/p99, error counts.
+    """
+    with open(path) as f:
+        records = [json.loads(_l) for _l in f if _l.strip()]
+    jobs = [(_r['t'], tuple(_r['job'])) for _r in records if 'job' in _r]
+    store = ReplayStore([_r for _r in records if 'sql' in _r])
+    pool.connect = store.connect
+    providers.factory = lambda api_key: FakeMandrill(api_key, latency, jitter, errors)
+    metrics.enabled = True
+    metrics.reset()
+    _rates = limiter.default_rate, limiter.client_rate
+    limiter.reset(rate or 1e9, rate or 1e9)
+
+    latencies, failures = [], [0]
+
+    def _job(job, scheduled):
+        try:
+            EmailDirector(*job)()
+        except Exception:
+            failures[0] += 1
+        # from the scheduled time: includes waiting for a free worker
+        latencies.append(time.time() - scheduled)
+
+    started = time.time()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for _offset, job in jobs:
+                _t = started + _offset / speed
+                if _t > time.time():
+                    time.sleep(_t - time.time())
+                executor.submit(_job, job, _t)
+        results.flush()
+    finally:
+        limiter.reset(*_rates)
+    elapsed = time.time() - started
+
+    stages = json.loads(metrics.dump())
+    return dict(
+        jobs=len(jobs), elapsed=elapsed, jobs_per_sec=len(jobs) / max(elapsed, 1e-6),
+        errors=failures[0], db_misses=store.misses, db_writes=store.writes,
+        p50=_percentile(latencies, .5), p99=_percentile(latencies, .99),
+        stages={_s: {_l: dict(p50=_v['p50'], p99=_v['p99'], count=_v['count'])
+                     for _l, _v in _labels.items()} for _s, _labels in stages.items()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded mail run.')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1.0, help='N times the recorded rate')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.1, help='provider latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--errors', type=float, default=0.0, help='provider error rate, 0..1')
+    parser.add_argument('--rate', type=float, default=None, help='send limit, msg/sec (default: none)')
+    _a = parser.parse_args()
+    print(json.dumps(replay(
+        _a.path, _a.speed, _a.workers, _a.latency, _a.jitter, _a.errors, _a.rate),
+        indent=2, sort_keys=True))
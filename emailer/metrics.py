@@ -0,0 +1,133 @@
+import json
+import time
+import bisect
+import random
+import threading
+import collections
+
+import settings
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """
+    Fixed-bucket latency histogram (seconds), Prometheus style.
+    """
+    __slots__ = ('counts', 'sum', 'count')
+    buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th observation.
+        """
+        _rank, _seen = q * self.count, 0
+        for _bound, _n in zip(self.buckets + (float('inf'),), self.counts):
+            _seen += _n
+            if _seen and _seen >= _rank:
+                return _bound
+        return 0.0
+
+
+class _Null(object):
+    """
+    Shared no-op timer returned while instrumentation is disabled.
+    """
+    __enter__ = lambda s: s
+    __exit__ = lambda s, *exc: False
+
+_null = _Null()
+
+
+class _Timer(object):
+    __slots__ = ('metrics', 'key', 'started')
+
+    def __init__(self, metrics, key):
+        self.metrics, self.key = metrics, key
+
+    def __enter__(self):
+        self.started = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.key, clock() - self.started)
+        return False
+
+
+class Metrics(object):
+    """
+    Per-stage latency instrumentation of the email pipeline.
+
+        with metrics.stage('render', 'MailType'):
+            ...
+
+    `sample` is either a rate (0..1) for all mail types,
+    or {mail_type: rate} with optional 'default' key.
+    """
+    def __init__(self, enabled=False, sample=1.0):
+        self.enabled, self.sample = enabled, sample
+        self._h = collections.defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def stage(self, name, label=''):
+        if not self.enabled:
+            return _null
+        _rate = self.sample
+        if isinstance(_rate, dict):
+            _rate = _rate.get(label, _rate.get('default', 1.0))
+        if _rate < 1 and random.random() >= _rate:
+            return _null
+        return _Timer(self, (name, '%s' % label))
+
+    def observe(self, key, value):
+        with self._lock:
+            self._h[key].observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._h.clear()
+
+    def histograms(self):
+        with self._lock:
+            return dict(self._h)
+
+    def prometheus(self, name='emailer_stage_seconds'):
+        """
+        Prometheus text exposition format.
+        """
+        lines = ['# TYPE %s histogram' % name]
+        for (stage, label), h in sorted(self.histograms().items()):
+            _l = 'stage="%s",mail_type="%s"' % (stage, label)
+            _cumulative = 0
+            for _bound, _n in zip(h.buckets + ('+Inf',), h.counts):
+                _cumulative += _n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, _l, _bound, _cumulative))
+            lines.append('%s_sum{%s} %f' % (name, _l, h.sum))
+            lines.append('%s_count{%s} %d' % (name, _l, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """
+        JSON: {stage: {mail_type: {count, sum, p50, p99, buckets}}}
+        """
+        _d = collections.defaultdict(dict)
+        for (stage, label), h in self.histograms().items():
+            _d[stage][label] = dict(
+                count=h.count, sum=h.sum, buckets=h.counts,
+                p50=h.quantile(.5), p99=h.quantile(.99))
+        return json.dumps(_d, sort_keys=True)
+
+
+metrics = Metrics(
+    enabled=getattr(settings, 'METRICS_ENABLED', False),
+    sample=getattr(settings, 'METRICS_SAMPLE', 1.0))
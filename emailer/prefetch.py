@@ -0,0 +1,65 @@
+import json
+import collections
+
+from lib.logger import Logger
+
+
+logger = Logger(__name__)
+
+
+class Frozen(dict):
+    """
+    Read-only dictionary, shared between Email instances of a batch.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return Frozen((_k, freeze(_v)) for _k, _v in obj.items())
+    if isinstance(obj, list):
+        return tuple(map(freeze, obj))
+    return obj
+
+
+class Prefetch(object):
+    """
+    Loads event data and job params of many mail jobs at once:
+    one IN (...) query for all distinct events (each JSON decoded once)
+    and one `bulk_params` query per mail type.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.events, self.params = {}, {}
+
+    def load(self, directors):
+        directors = list(directors)
+        self._load_events(set(_d.event_id for _d in directors) - set(self.events))
+        by_type = collections.defaultdict(list)
+        for _d in directors:
+            by_type[_d.mail_type].append(_d.job)
+        for cls, jobs in by_type.items():
+            _p = cls.bulk_params(self.db, jobs)
+            self.params.update({(cls, _k): freeze(_v) for _k, _v in _p.items()})
+        return self
+
+    def _load_events(self, event_ids):
+        if not event_ids:
+            return
+        sql = '''
+            SELECT ...
+            WHERE ... IN %s
+        ;'''
+        for _id, _data in self.db.select(sql, (tuple(event_ids),)) or ():
+            self.events[_id] = freeze(json.loads(_data))
+        logger.debug('%d events prefetched' % len(event_ids))
+
+    def event(self, event_id):
+        return self.events.get(event_id)
+
+    def param(self, cls, key):
+        return self.params.get((cls, key))
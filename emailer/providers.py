@@ -0,0 +1,92 @@
+import time
+import threading
+import contextlib
+import collections
+
+import mandrill
+
+import settings
+
+
+class ProviderPool(object):
+    """
+    Pool of reusable provider clients keyed by API key.
+    Every Mandrill client keeps its own HTTP session,
+    so reusing one skips connection setup and TLS handshake.
+    """
+    def __init__(self, factory=mandrill.Mandrill, max_per_key=4, idle_timeout=300):
+        self.factory = factory
+        self.max_per_key, self.idle_timeout = max_per_key, idle_timeout
+        self.created = self.reused = self.evicted = self.discarded = 0
+        self._idle = collections.defaultdict(list)   # api_key: [(released_at, client)]
+        self._busy = collections.Counter()
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def borrow(self, api_key):
+        """
+        with providers.borrow(api_key) as client:
+            client.messages.send(...)
+        Client is dropped instead of returned if a non-API error
+        (i.e. broken connection) escapes the block.
+        """
+        client = self.acquire(api_key)
+        try:
+            yield client
+        except mandrill.Error:
+            self.release(api_key, client)
+            raise
+        except Exception:
+            self.release(api_key, client, discard=True)
+            raise
+        else:
+            self.release(api_key, client)
+
+    def acquire(self, api_key):
+        with self._cond:
+            self._evict()
+            while not self._idle[api_key] and self._busy[api_key] >= self.max_per_key:
+                self._cond.wait()
+            self._busy[api_key] += 1
+            if self._idle[api_key]:
+                self.reused += 1
+                return self._idle[api_key].pop()[1]
+            self.created += 1
+        try:
+            return self.factory(api_key)
+        except Exception:
+            self.release(api_key, None, discard=True)
+            raise
+
+    def release(self, api_key, client, discard=False):
+        with self._cond:
+            self._busy[api_key] -= 1
+            if discard:
+                self.discarded += 1
+            else:
+                self._idle[api_key].append((time.time(), client))
+            self._cond.notify()
+
+    def _evict(self):
+        _deadline = time.time() - self.idle_timeout
+        for api_key, clients in list(self._idle.items()):
+            _fresh = [_c for _c in clients if _c[0] >= _deadline]
+            self.evicted += len(clients) - len(_fresh)
+            if _fresh:
+                self._idle[api_key] = _fresh
+            else:
+                del self._idle[api_key]
+
+    def stats(self):
+        _borrowed = self.created + self.reused
+        return dict(
+            created=self.created, reused=self.reused,
+            evicted=self.evicted, discarded=self.discarded,
+            idle=sum(map(len, self._idle.values())),
+            busy=sum(self._busy.values()),
+            reuse_ratio=_borrowed and float(self.reused) / _borrowed or 0.0)
+
+
+providers = ProviderPool(
+    max_per_key=getattr(settings, 'PROVIDER_POOL_SIZE', 4),
+    idle_timeout=getattr(settings, 'PROVIDER_IDLE_TIMEOUT', 300))
@@ -0,0 +1,143 @@
+import time
+import threading
+
+import mandrill
+
+import settings
+
+
+# Mandrill `queued_reason` values meaning the account is being held back
+THROTTLE_REASONS = frozenset((
+    'hourly-quota-exhausted', 'monthly-limit-reached', 'sending-backlog', 'sending-paused'))
+
+
+class TokenBucket(object):
+    """
+    Token bucket with reservations: a caller takes its tokens right away,
+    possibly driving the balance negative, and waits until it is paid off.
+    That keeps callers in FIFO order without a queue of their own.
+
+    Rate adapts AIMD style: halved on throttling, slowly restored on success.
+    """
+    def __init__(self, rate, burst=None):
+        self.ceiling = self.rate = float(rate)
+        self.floor = self.ceiling / 32
+        self.burst = float(burst or rate)
+        self.tokens, self.stamp = self.burst, time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        """
+        Take `cost` tokens, return seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= cost
+            return self.tokens < 0 and -self.tokens / self.rate or 0.0
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.floor, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.ceiling, self.rate + self.ceiling / 20)
+
+
+class RateLimiter(object):
+    """
+    Send scheduler: one TokenBucket per (api_key, ip_pool).
+    Default mailserver and client-owned mailservers get separate rates (msg/sec).
+    """
+    def __init__(self, default_rate=50, client_rate=10, burst=2.0):
+        self.default_rate, self.client_rate, self.burst = default_rate, client_rate, burst
+        self.waiting = self.waited = self.throttles = 0
+        self.wait_time = self.max_wait = 0.0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, api_key, ip_pool):
+        key = api_key, ip_pool
+        try:
+            return self._buckets[key]
+        except KeyError:
+            _rate = api_key == settings.MANDRILL_API_KEY and self.default_rate or self.client_rate
+            with self._lock:
+                return self._buckets.setdefault(key, TokenBucket(_rate, _rate * self.burst))
+
+    def reset(self, default_rate=None, client_rate=None):
+        """
+        Drop all buckets (and their adapted rates), optionally with new rates.
+        """
+        with self._lock:
+            self.default_rate = default_rate or self.default_rate
+            self.client_rate = client_rate or self.client_rate
+            self._buckets = {}
+
+    def reserve(self, api_key, ip_pool, cost=1):
+        """
+        Seconds the caller must wait; caller sleeps and then calls `done`.
+        """
+        wait = self.bucket(api_key, ip_pool).reserve(cost)
+        with self._lock:
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait:
+                self.waited += 1
+                self.waiting += 1
+        return wait
+
+    def done(self, wait):
+        if wait:
+            with self._lock:
+                self.waiting -= 1
+
+    def acquire(self, api_key, ip_pool, cost=1):
+        """
+        Blocking version of `reserve` for threaded senders.
+        """
+        wait = self.reserve(api_key, ip_pool, cost)
+        try:
+            if wait:
+                time.sleep(wait)
+        finally:
+            self.done(wait)
+
+    def feedback(self, api_key, ip_pool, response=None, error=None):
+        """
+        Adapt rate to provider response (list of per-recipient results) or error.
+        """
+        _b = self.bucket(api_key, ip_pool)
+        if self.is_throttle(response, error):
+            self.throttles += 1
+            _b.throttled()
+        elif error is None:
+            _b.succeeded()
+
+    @staticmethod
+    def is_throttle(response=None, error=None):
+        """
+        Mandrill's ServiceUnavailableError, or HTTP 429 / 503 where the
+        transport knows the status (`error.status`, i.e. HTTPTransport).
+        """
+        if error is not None:
+            return isinstance(error, mandrill.ServiceUnavailableError) or \
+                getattr(error, 'status', None) in (429, 503)
+        return any(_r.get('queued_reason') in THROTTLE_REASONS for _r in response or ())
+
+    def stats(self):
+        with self._lock:
+            buckets = {'%s/%s' % (_k[0][-4:], _k[1]): dict(rate=_b.rate, tokens=_b.tokens)
+                       for _k, _b in self._buckets.items()}
+        return dict(
+            queue_depth=self.waiting, waited=self.waited, throttles=self.throttles,
+            wait_time=self.wait_time, max_wait=self.max_wait, buckets=buckets)
+
+
+limiter = RateLimiter(
+    default_rate=getattr(settings, 'SEND_RATE_DEFAULT', 50),
+    client_rate=getattr(settings, 'SEND_RATE_CLIENT', 10),
+    burst=getattr(settings, 'SEND_RATE_BURST', 2.0))
@@ -0,0 +1,100 @@
+import os
+import json
+import threading
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from lib.logger import Logger
+from dbpool import pool, PooledDB
+
+
+logger = Logger(__name__)
+
+
+class MailTypeRegistry(Mapping):
+    """
+    {mail type id: Email subclass}, resolved on first use.
+
+    All `EmailMetaClass._dbkeys` are looked up with a single query,
+    or read from a local JSON snapshot ({name: id}) when one is present,
+    so importing the director needs no database at all.
+    """
+    def __init__(self, base, snapshot=None):
+        self.base, self.snapshot = base, snapshot
+        self._map, self._keys = None, None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self._registry()[key]
+
+    def __iter__(self):
+        return iter(self._registry())
+
+    def __len__(self):
+        return len(self._registry())
+
+    def key(self, cls):
+        """
+        Mail type id of an Email subclass (same as `cls.dbkey()`, without a query).
+        """
+        self._registry()
+        return self._keys[cls]
+
+    def refresh(self):
+        """
+        Forget resolved ids, next access queries the database.
+        """
+        with self._lock:
+            self._map = self._keys = None
+        return self._registry(use_snapshot=False)
+
+    def _registry(self, use_snapshot=True):
+        if self._map is None:
+            with self._lock:
+                if self._map is None:
+                    self._resolve(use_snapshot)
+        return self._map
+
+    def _resolve(self, use_snapshot):
+        classes = {_c._dbkeys[_c.__name__]: _c for _c in self.base.__subclasses__()}
+        ids = use_snapshot and self.load() or {}
+        if set(classes) - set(ids):
+            ids = self._query(tuple(classes))
+            self.save(ids)
+        missing = set(classes) - set(ids)
+        if missing:
+            raise ValueError('%s was not found' % ', '.join(sorted(missing)))
+        self._map = {ids[_n]: _c for _n, _c in classes.items()}
+        self._keys = {_c: _k for _k, _c in self._map.items()}
+
+    def _query(self, names):
+        sql = '''
+            SELECT ...
+            WHERE ... IN %s
+        ;'''
+        with pool.lease():
+            _r = PooledDB().select(sql, (names,))
+        return {_name: _id for _id, _name in _r or ()}
+
+    def load(self):
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return {}
+        try:
+            with open(self.snapshot) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logger.error('Mail type snapshot %s is unreadable: %s' % (self.snapshot, e))
+            return {}
+
+    def save(self, ids):
+        if not self.snapshot:
+            return
+        _tmp = '%s.%d' % (self.snapshot, os.getpid())
+        try:
+            with open(_tmp, 'w') as f:
+                json.dump(ids, f)
+            os.rename(_tmp, self.snapshot)
+        except (IOError, OSError) as e:
+            logger.error('Mail type snapshot %s was not saved: %s' % (self.snapshot, e))
@@ -0,0 +1,184 @@
+import time
+import collections
+from concurrent import futures
+
+from lib.logger import Logger
+from dbpool import pool, PooledDB
+from email_director import EmailDirector
+from writer import results
+import settings
+
+
+logger = Logger(__name__)
+
+
+def forked():
+    """
+    Process pool initializer: children must not share parent's connections.
+    """
+    pool.reset()
+
+
+def execute(director, job, flush=False):
+    """
+    Worker body (module level, so process pools can pickle it).
+    Returns (started, finished, ok). A process pool worker `flush`es its
+    results after every job; threads share the process-wide buffer.
+    """
+    started = time.time()
+    try:
+        director(*job)()
+        ok = True
+    except Exception as e:
+        logger.error('Mail job #%s failed: %s' % (job[0], e))
+        ok = False
+    finally:
+        if flush:
+            results.flush()
+    return started, time.time(), ok
+
+
+class Scheduler(object):
+    """
+    In-process mail job scheduler.
+
+    Pending jobs are pulled from the database and queued by priority of their
+    mail type (lower runs first, i.e. transactional before bulk).
+    Within a priority clients take turns, one job each, so one big client
+    can not starve the others. Directors run on a thread or process pool;
+    jobs running past `deadline` seconds are reported, but keep their worker
+    (threads can't be killed) until they really return.
+    Pending jobs are fetched again every `refetch` seconds, highest priority
+    first, so a fresh transactional job overtakes a queued bulk window.
+    """
+    def __init__(self, director=EmailDirector, workers=4, processes=False,
+                 deadline=300, poll=5, fetch=500, priorities=None, refetch=1):
+        self.director, self.workers, self.processes = director, workers, processes
+        self.deadline, self.poll, self.fetch_size = deadline, poll, fetch
+        self.refetch, self._fetched = refetch, 0
+        self.priorities = priorities or getattr(settings, 'MAIL_TYPE_PRIORITY', {})
+        if processes:
+            self.executor = futures.ProcessPoolExecutor(max_workers=workers, initializer=forked)
+        else:
+            self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.processed = self.failed = self.timed_out = 0
+        self.latency = self.max_latency = 0.0
+        self.started = time.time()
+        self._queues = collections.defaultdict(collections.OrderedDict)  # prio: {client: deque}
+        self._known, self._running, self._overdue = set(), {}, {}
+        self._stop = False
+
+    def fetch(self):
+        """
+        Pending jobs: (mail_job_id, event_id, extra_param, mail_type, client_id),
+        highest priority first.
+        """
+        self._fetched = time.time()
+        _prios = sorted((_k, _v) for _k, _v in self.priorities.items() if _k != 'default')
+        if _prios:
+            _order = 'CASE ... %s ELSE %%s END, ' % ' '.join(['WHEN %s THEN %s'] * len(_prios))
+        else:
+            _order = ''
+        sql = '''
+            SELECT ...
+            ORDER BY %s...
+            LIMIT %%s
+        ;''' % _order
+        _args = tuple(_v for _p in _prios for _v in _p)
+        _args += _prios and (self.priorities.get('default', 10),) or ()
+        with pool.lease():
+            return PooledDB().select(sql, _args + (self.fetch_size,)) or ()
+
+    def enqueue(self, rows):
+        now = time.time()
+        for _row in rows:
+            job, client_id = tuple(_row[:4]), _row[4]
+            if job[0] in self._known:
+                continue
+            self._known.add(job[0])
+            _prio = self.priorities.get(job[3], self.priorities.get('default', 10))
+            self._queues[_prio].setdefault(client_id, collections.deque()).append((now, job))
+
+    def next(self):
+        """
+        Head of the first client in line at the highest priority;
+        that client then goes to the back of the line.
+        """
+        for _prio in sorted(self._queues):
+            clients = self._queues[_prio]
+            while clients:
+                client_id, queue = clients.popitem(last=False)
+                if queue:
+                    _item = queue.popleft()
+                    if queue:
+                        clients[client_id] = queue
+                    return _item
+            del self._queues[_prio]
+        return None
+
+    def backlog(self):
+        _b = collections.Counter()
+        for clients in self._queues.values():
+            for client_id, queue in clients.items():
+                _b[client_id] += len(queue)
+        return dict(_b)
+
+    def stop(self):
+        self._stop = True
+
+    def run(self, once=False):
+        while not self._stop:
+            # `enqueue` skips jobs already known
+            if not self._queues or time.time() - self._fetched >= self.refetch:
+                self.enqueue(self.fetch())
+            while len(self._running) + len(self._overdue) < self.workers:
+                _item = self.next()
+                if _item is None:
+                    break
+                _future = self.executor.submit(execute, self.director, _item[1], self.processes)
+                # job may be fetched again only after it really returned
+                _future.add_done_callback(lambda _f, _id=_item[1][0]: self._known.discard(_id))
+                self._running[_future] = _item + (time.time(),)
+            self._collect()
+            if once and not self._queues and not self._running and not self._overdue:
+                break
+            if not self._running and not self._overdue and not self._queues:
+                time.sleep(self.poll)
+        self.executor.shutdown(wait=True)
+        results.flush()
+
+    def _collect(self):
+        if not self._running and not self._overdue:
+            return
+        done, _ = futures.wait(
+            list(self._running) + list(self._overdue), timeout=1, return_when=futures.FIRST_COMPLETED)
+        for _future in done:
+            # late jobs count as processed where they were reported timed out
+            self._overdue.pop(_future, None)
+        now = time.time()
+        for _future, (queued, job, submitted) in list(self._running.items()):
+            if _future in done:
+                del self._running[_future]
+                try:
+                    started, _, ok = _future.result()
+                except Exception as e:
+                    logger.error('Mail job #%s crashed its worker: %s' % (job[0], e))
+                    started, ok = submitted, False
+                self.processed += 1
+                self.failed += not ok
+                self.latency += started - queued
+                self.max_latency = max(self.max_latency, started - queued)
+            elif now - submitted > self.deadline:
+                # its worker stays busy: keep counting it against `workers`
+                self._overdue[_future] = self._running.pop(_future)
+                self.timed_out += 1
+                logger.error('Mail job #%s missed its %ss deadline.' % (job[0], self.deadline))
+
+    def stats(self):
+        _elapsed = max(time.time() - self.started, 1e-6)
+        return dict(
+            processed=self.processed, failed=self.failed, timed_out=self.timed_out,
+            running=len(self._running), overdue=len(self._overdue),
+            throughput=self.processed / _elapsed,
+            queue_latency=self.processed and self.latency / self.processed or 0.0,
+            max_queue_latency=self.max_latency, backlog=self.backlog())
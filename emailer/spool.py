@@ -0,0 +1,182 @@
+import json
+import time
+import sqlite3
+import threading
+from concurrent import futures
+
+import mandrill
+
+from lib.logger import Logger
+
+
+logger = Logger(__name__)
+
+
+class Spool(object):
+    """
+    Durable local spool (SQLite, WAL journal) of rendered payloads.
+    Workers append and carry on; Drainers deliver them later,
+    so provider latency never blocks job completion.
+
+    Row life-cycle: queued -> sent (provider accepted) -> deleted (job updated),
+    or dead after `max_attempts` failures. A drainer claims rows by leasing
+    them until `leased` (epoch seconds); other drainers, in this process or
+    another one, skip them until the lease expires.
+    """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS spool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            api_key TEXT NOT NULL,
+            message TEXT NOT NULL,
+            submid TEXT,
+            state TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL,
+            leased REAL NOT NULL DEFAULT 0,
+            error TEXT
+        )
+    '''
+
+    def __init__(self, path, max_attempts=8, backoff=2.0, max_backoff=900):
+        self.path, self.max_attempts = path, max_attempts
+        self.backoff, self.max_backoff = backoff, max_backoff
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(self.schema)
+        # spools created before leases
+        if 'leased' not in [_c[1] for _c in self._db.execute('PRAGMA table_info(spool)')]:
+            self._db.execute('ALTER TABLE spool ADD COLUMN leased REAL NOT NULL DEFAULT 0')
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def __len__(self):
+        return self._query("SELECT count(*) FROM spool WHERE state != 'dead'")[0][0]
+
+    def append(self, job, api_key, message, submid=None):
+        """
+        Store a rendered payload, return its spool id once it is on disk.
+        """
+        sql = 'INSERT INTO spool (job, api_key, message, submid, next_try) VALUES (?, ?, ?, ?, ?)'
+        _args = json.dumps(job), api_key, json.dumps(message), json.dumps(submid), time.time()
+        return self._execute(sql, _args).lastrowid
+
+    def claim(self, limit=100, lease=300):
+        """
+        Lease up to `limit` due rows for `lease` seconds and return them.
+        """
+        sql = '''
+            SELECT id, job, api_key, message, submid, state, attempts FROM spool
+            WHERE state IN ('queued', 'sent') AND next_try <= ? AND leased <= ?
+            ORDER BY id LIMIT ?
+        '''
+        now = time.time()
+        with self._lock:
+            # write lock up front: drainers of other processes wait here
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(sql, (now, now, limit)).fetchall()
+                self._db.executemany(
+                    'UPDATE spool SET leased = ? WHERE id = ?', [(now + lease, _r[0]) for _r in rows])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return [
+            (_id, json.loads(_j), _k, json.loads(_m), json.loads(_s), _st, _a)
+            for _id, _j, _k, _m, _s, _st, _a in rows]
+
+    def sent(self, spool_id):
+        self._execute("UPDATE spool SET state = 'sent' WHERE id = ?", (spool_id,))
+
+    def ack(self, spool_id):
+        self._execute('DELETE FROM spool WHERE id = ?', (spool_id,))
+
+    def retry(self, spool_id, attempts, error):
+        """
+        Exponential backoff, lease released; rows out of attempts are kept as 'dead'.
+        """
+        attempts += 1
+        if attempts >= self.max_attempts:
+            sql = "UPDATE spool SET state = 'dead', attempts = ?, error = ? WHERE id = ?"
+            self._execute(sql, (attempts, '%s' % error, spool_id))
+            return False
+        _delay = min(self.backoff ** attempts, self.max_backoff)
+        sql = 'UPDATE spool SET attempts = ?, next_try = ?, leased = 0, error = ? WHERE id = ?'
+        self._execute(sql, (attempts, time.time() + _delay, '%s' % error, spool_id))
+        return True
+
+
+class Drainer(threading.Thread):
+    """
+    Background delivery of spooled payloads by `workers` threads:
+    provider send, then `_keep_communication` and `update_mail_job`.
+    Rows are claimed only as workers free up, so several drainers
+    can share one spool.
+    """
+    def __init__(self, spool, director, interval=1.0, batch=100, workers=8, lease=300):
+        super(Drainer, self).__init__(name='spool-drainer')
+        self.daemon = True
+        self.spool, self.director = spool, director
+        self.interval, self.batch = interval, batch
+        self.workers, self.lease = workers, lease
+        self._idle = workers
+        self._cond = threading.Condition()
+        self._halt = threading.Event()
+
+    def stop(self):
+        self._halt.set()
+
+    def run(self):
+        executor = futures.ThreadPoolExecutor(self.workers)
+        try:
+            while not self._halt.is_set():
+                with self._cond:
+                    if not self._idle:
+                        self._cond.wait(self.interval)
+                    _free = min(self._idle, self.batch)
+                rows = _free and self.spool.claim(_free, self.lease) or []
+                with self._cond:
+                    self._idle -= len(rows)
+                for row in rows:
+                    executor.submit(self._work, row)
+                if _free and not rows:
+                    self._halt.wait(self.interval)
+        finally:
+            # let deliveries in flight finish
+            executor.shutdown(wait=True)
+
+    def _work(self, row):
+        try:
+            self.deliver(*row)
+        finally:
+            with self._cond:
+                self._idle += 1
+                self._cond.notify()
+
+    def deliver(self, spool_id, job, api_key, message, submid, state, attempts):
+        director = None
+        try:
+            director = self.director(*job)
+            if state == 'queued':
+                director.mandrill(api_key=api_key, datablock=message)
+                self.spool.sent(spool_id)
+            director.update_mail_job(director.revive(submid))
+        except Exception as e:
+            _m = isinstance(e, mandrill.Error) and 'provider' or 'delivery'
+            logger.error('Spooled mail job #%s %s error: %s' % (job[0], _m, e))
+            self.spool.retry(spool_id, attempts, e)
+            return False
+        finally:
+            if director is not None:
+                director.close()
+        self.spool.ack(spool_id)
+        return True
@@ -0,0 +1,106 @@
+"""
+Memory-bounded streaming mode for large mail runs.
+
+Jobs are consumed lazily, every rendered Email is reduced to a compact
+Envelope right away and its payload is dropped once the provider accepted it,
+so memory stays flat no matter how many jobs pass through.
+"""
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from lib.logger import Logger
+from email_director import EmailDirector
+from suppression import Suppressed, SUPPRESSED_STATUS
+from writer import results
+import settings
+
+
+logger = Logger(__name__)
+
+
+class Envelope(object):
+    """
+    Compact stand-in for a rendered Email: what sending and
+    `update_mail_job` / `update_status` need, nothing else.
+    """
+    __slots__ = ('job_id', 'mailjob', 'submid', 'update')
+
+    def __init__(self, director, Mail):
+        self.job_id, self.mailjob, self.submid = director.job_id, Mail.mailjob, Mail.submid
+        self.update = director.update
+
+    def drop(self):
+        self.mailjob = None
+
+
+class MemoryReport(object):
+    """
+    tracemalloc based: current and peak traced memory per `every` jobs.
+    """
+    def __init__(self, every=1000):
+        self.every, self.rows = every, []
+        self.enabled = tracemalloc is not None
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def tick(self, jobs):
+        if not self.enabled or jobs % self.every:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.rows.append((jobs, current, peak))
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        logger.info('%d jobs: %.1f KiB current, %.1f KiB peak per %d jobs' % (
+            jobs, current / 1024.0, peak / 1024.0, self.every))
+
+    def stop(self):
+        if self.enabled:
+            tracemalloc.stop()
+        return self.rows
+
+    def __str__(self):
+        _l = ['%10s %14s %14s' % ('jobs', 'current KiB', 'peak KiB')]
+        _l += ['%10d %14.1f %14.1f' % (_j, _c / 1024.0, _p / 1024.0) for _j, _c, _p in self.rows]
+        return '\n'.join(_l)
+
+
+def stream(jobs, director=EmailDirector, report=None):
+    """
+    Process (mail_job_id, event_id, extra_param, mail_type) tuples one by one,
+    yields (mail_job_id, ok). `jobs` may be any iterator (i.e. a server-side cursor).
+    """
+    processed = 0
+    try:
+        for job in jobs:
+            yield job[0], _run(director, job)
+            processed += 1
+            if report is not None:
+                report.tick(processed)
+    finally:
+        results.flush()
+
+
+def _run(director, job):
+    _d = None
+    try:
+        # a job that can't even be started (i.e. unknown mail type) fails alone
+        _d = director(*job)
+        envelope = Envelope(_d, _d.prepare_email())
+        try:
+            _d.send_email(*envelope.mailjob)
+            status, sent = settings.JOB_STATUS['...'], True
+        except Suppressed as e:
+            logger.info(e)
+            status, sent = SUPPRESSED_STATUS, False
+        envelope.drop()
+        _d.update_mail_job(envelope, status)
+        return sent
+    except Exception as e:
+        logger.error('Mail job #%s failed: %s' % (job[0], e))
+        return False
+    finally:
+        if _d is not None:
+            _d.close()
+
@@ -0,0 +1,174 @@
+import math
+import time
+import hashlib
+import threading
+
+from lib.logger import Logger
+from dbpool import pool, PooledDB
+import settings
+
+
+logger = Logger(__name__)
+
+# job status for suppressed recipients: done, but not sent
+SUPPRESSED_STATUS = settings.JOB_STATUS['suppressed']
+
+
+class Suppressed(Exception):
+    """
+    Recipient is on the suppression list, mail must not be sent.
+    """
+
+
+class BloomFilter(object):
+    """
+    Compact membership test for large suppression lists.
+    False positives happen at roughly `error_rate`, false negatives never.
+    """
+    def __init__(self, capacity, error_rate=0.0001):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, item):
+        _d = hashlib.md5(item.encode('utf-8')).hexdigest()
+        _a, _b = int(_d[:16], 16), int(_d[16:], 16) | 1
+        return ((_a + _i * _b) % self.size for _i in range(self.hashes))
+
+    def add(self, item):
+        for _p in self._positions(item):
+            self.bits[_p >> 3] |= 1 << (_p & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[_p >> 3] & (1 << (_p & 7)) for _p in self._positions(item))
+
+
+class SuppressionIndex(object):
+    """
+    In-memory index of addresses the provider already rejected
+    (hard bounces, spam complaints, invalid addresses), per Mandrill account,
+    and of unsubscribers, per client: `(api_key, client_id, email) in suppressed`.
+
+    Loaded from the database in a background thread, refreshed every
+    `refresh_after` seconds and updated incrementally from delivery results;
+    checks never wait for a load (before the first one completes, only
+    observed addresses are known). Lists larger than `bloom_over` are kept
+    in a Bloom filter, recent additions in a set.
+    """
+    statuses = frozenset(('invalid',))
+    reasons = frozenset(('hard-bounce', 'spam', 'unsub', 'invalid'))
+
+    def __init__(self, bloom_over=200000, error_rate=0.0001, refresh_after=3600):
+        self.bloom_over, self.error_rate = bloom_over, error_rate
+        self.refresh_after = refresh_after
+        self.checks = self.hits = 0
+        self._bloom, self._set, self._loaded = None, set(), 0
+        self._loading = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(email):
+        return ('%s' % email).strip().lower()
+
+    @classmethod
+    def key(cls, scope, owner, email):
+        """
+        scope: 'account' (owner is an api key) or 'client' (owner is a client id).
+        """
+        return '%s:%s %s' % (scope, owner or '', cls.normalize(email))
+
+    def __contains__(self, item):
+        if time.time() - self._loaded >= self.refresh_after:
+            self.refresh()
+        api_key, client_id, email = item
+        self.checks += 1
+        found = any(self._has(self.key(*_k)) for _k in (
+            ('account', api_key, email), ('client', client_id, email)))
+        self.hits += found
+        return found
+
+    def _has(self, key):
+        return key in self._set or (self._bloom is not None and key in self._bloom)
+
+    def add(self, scope, owner, email):
+        with self._lock:
+            self._set.add(self.key(scope, owner, email))
+
+    def observe(self, rows, api_key=None):
+        """
+        Pick suppressible addresses from provider results of an account.
+        """
+        for _r in rows:
+            if _r.get('status') in self.statuses or _r.get('reject_reason') in self.reasons:
+                self.add('account', api_key, _r['email'])
+
+    def refresh(self):
+        """
+        Start a background load, unless one is running or the list is fresh.
+        """
+        with self._lock:
+            if self._loading or time.time() - self._loaded < self.refresh_after:
+                return False
+            self._loading = True
+        _t = threading.Thread(target=self.load, name='suppression-load')
+        _t.daemon = True
+        _t.start()
+        return True
+
+    def load(self):
+        try:
+            try:
+                keys = set(self.key(*_r) for _r in self._query())
+            except Exception as e:
+                # keep what we have, try again later
+                logger.error('Suppression list was not loaded: %s' % e)
+                self._loaded = time.time() - self.refresh_after / 2.0
+                return
+            if len(keys) > self.bloom_over:
+                bloom = BloomFilter(len(keys) * 2, self.error_rate)
+                for _k in keys:
+                    bloom.add(_k)
+            else:
+                bloom = None
+            with self._lock:
+                # addresses observed since the last load may not be written yet
+                if bloom is None:
+                    self._bloom, self._set = None, keys | self._set
+                else:
+                    for _k in self._set:
+                        bloom.add(_k)
+                    self._bloom, self._set = bloom, set()
+                self._loaded = time.time()
+            logger.info('%d suppressed addresses loaded.' % len(keys))
+        finally:
+            self._loading = False
+
+    def _query(self):
+        """
+        (scope, owner, email): ('account', api_key, email) for addresses a
+        Mandrill account rejected, ('client', client_id, email) for unsubscribers.
+        """
+        rejected = '''
+            SELECT ..., ...
+            WHERE ... IN %s OR ... IN %s
+        ;'''
+        unsubscribed = '''
+            SELECT ..., ...
+        ;'''
+        with pool.lease():
+            _db = PooledDB()
+            _r = list(_db.select(rejected, (tuple(self.statuses), tuple(self.reasons))) or ())
+            _u = list(_db.select(unsubscribed, ()) or ())
+        return [('account', _row[0], _row[1]) for _row in _r] + [
+            ('client', _row[0], _row[1]) for _row in _u]
+
+    def stats(self):
+        return dict(
+            size=len(self._set), bloom=self._bloom is not None and self._bloom.size or 0,
+            checks=self.checks, hits=self.hits, loaded=self._loaded)
+
+
+suppressed = SuppressionIndex(
+    bloom_over=getattr(settings, 'SUPPRESSION_BLOOM_OVER', 200000),
+    refresh_after=getattr(settings, 'SUPPRESSION_REFRESH', 3600))
@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import hashlib
+import threading
+import collections
+
+from lib.template import Template
+from cache import TTLCache
+import settings
+
+
+class TemplateCache(object):
+    """
+    LRU cache of compiled templates, keyed by (client_id, template_name)
+    (client_id is '' for default templates).
+
+    Lookups of client overrides are memoized as well, including negative
+    results. Both are re-validated against the filesystem at most every
+    `check_interval` seconds, so edited templates are picked up by mtime
+    without a restart.
+    """
+    def __init__(self, root, maxsize=256, check_interval=5):
+        self.root, self.maxsize, self.check_interval = root, maxsize, check_interval
+        self.hits = self.misses = self.reloads = 0
+        self._compiled = collections.OrderedDict()  # key: [checked_at, mtime, size, template, generation]
+        self._generation = 0
+        self._located = {}                          # key: [checked_at, found]
+        self._partials = TTLCache(ttl=600, maxsize=maxsize)
+        self._lock = threading.RLock()
+
+    def locate(self, client_id, template):
+        """
+        Does client folder hold its own version of a template?
+        """
+        key, now = ('%s' % client_id, template), time.time()
+        with self._lock:
+            _e = self._located.get(key)
+            if _e is None or now - _e[0] >= self.check_interval:
+                _e = self._located[key] = [now, os.path.exists(os.path.join(self.root, *key))]
+            return _e[1]
+
+    def get(self, path):
+        """
+        Compiled template for a path as returned by TemplateDescriptor,
+        i.e. '<client_id>/<template>' or '<template>'.
+        """
+        return self._entry(path)[3]
+
+    def _entry(self, path):
+        _folder, _, _name = path.rpartition('/')
+        key, now = (_folder, _name), time.time()
+        with self._lock:
+            _e = self._compiled.pop(key, None)
+            if _e and now - _e[0] >= self.check_interval:
+                _e[0] = now
+                if self._mtime(path)[0] != _e[1]:
+                    self.reloads += 1
+                    _e = None
+            if _e is None:
+                self.misses += 1
+                self._generation += 1
+                _e = [now] + list(self._mtime(path)) + [Template(path), self._generation]
+            else:
+                self.hits += 1
+            self._compiled[key] = _e
+            while len(self._compiled) > self.maxsize:
+                self._compiled.popitem(last=False)
+            return _e
+
+    def invalidate(self):
+        with self._lock:
+            self._compiled.clear()
+            self._located.clear()
+            self._partials.invalidate()
+
+    def _mtime(self, path):
+        try:
+            _st = os.stat(os.path.join(self.root, path))
+        except OSError:
+            return None, 0
+        return _st.st_mtime, _st.st_size
+
+    def stats(self):
+        """
+        Hit rates and approximate memory use
+        (template sources plus compiled objects).
+        """
+        _total = self.hits + self.misses
+        with self._lock:
+            _mem = sum(_e[2] + sys.getsizeof(_e[3]) for _e in self._compiled.values())
+            return dict(
+                size=len(self._compiled), maxsize=self.maxsize,
+                locations=len(self._located),
+                missing=sum(1 for _e in self._located.values() if not _e[1]),
+                hits=self.hits, misses=self.misses, reloads=self.reloads,
+                ratio=_total and float(self.hits) / _total or 0.0,
+                memory=_mem)
+
+    def partial(self, key, path, shared, slots, escape=None):
+        """
+        Two-phase rendering for mass sends.
+        Page is rendered once per `key` (i.e. event, client, template) and
+        `shared` context, then only per-recipient `slots` are filled in.
+        Pages of a reloaded template are never reused (keyed by its generation).
+        """
+        _e = self._entry(path)
+        _shared = json.dumps(shared, sort_keys=True, default=str)
+        _key = key + (path, _e[4], hashlib.md5(_shared.encode('utf-8')).hexdigest())
+        page = self._partials.get(_key)
+        if page is None:
+            page = self._partials.set(_key, Partial(_e[3], shared, slots))
+        return page.fill(slots, escape)
+
+
+class Partial(object):
+    """
+    Rendered page split around slot markers:
+    parts[0] + slot[0] + parts[1] + ... + parts[-1]
+
+    Slot values are joined in verbatim (or through `escape`), so templates
+    must output them unmodified, as they would any already-safe URL.
+    """
+    __slots__ = ('parts', 'slots')
+
+    def __init__(self, template, shared, slots):
+        _token, names = uuid.uuid4().hex, sorted(slots)
+        markers = {_n: 'slot%sx%dx' % (_token, _i) for _i, _n in enumerate(names)}
+        _page = template.render(dict(shared, **markers))
+        _chunks = re.split(r'slot%sx(\d+)x' % _token, _page)
+        self.parts = tuple(_chunks[::2])
+        self.slots = tuple(names[int(_i)] for _i in _chunks[1::2])
+
+    def fill(self, values, escape=None):
+        _v = [values[_n] for _n in self.slots]
+        if escape:
+            _v = [escape(_x) for _x in _v]
+        _out = [None] * (len(self.parts) + len(self.slots))
+        _out[::2], _out[1::2] = self.parts, _v
+        return ''.join(_out)
+
+
+templates = TemplateCache(
+    settings.TEMPLATE_PATH,
+    maxsize=getattr(settings, 'TEMPLATE_CACHE_SIZE', 256),
+    check_interval=getattr(settings, 'TEMPLATE_CHECK_INTERVAL', 5))
@@ -0,0 +1,136 @@
+import time
+import atexit
+import threading
+
+from lib.logger import Logger
+from dbpool import pool, PooledDB, NO_PREPARE
+import settings
+
+
+logger = Logger(__name__)
+
+
+class ResultWriter(object):
+    """
+    Buffered writer for delivery results
+    (job_id, email, status, reject_reason, _id).
+
+    Rows are flushed as a single multi-row INSERT once `size` rows are
+    collected, after `interval` seconds, or on process shutdown.
+    A failed flush keeps its rows buffered for the next attempt; a chunk
+    failing `retries` times in a row is written row by row, rows the
+    database refuses are logged in full and counted in `rejected`.
+    No row is dropped: beyond `limit` buffered rows `add` blocks, flushing
+    until the buffer fits again.
+    """
+    # DB-API errors caused by the rows themselves, not by the connection
+    permanent = ('IntegrityError', 'DataError', 'ProgrammingError')
+    columns = 5
+    # one text per chunk size: not worth a prepared statement each
+    sql = NO_PREPARE + '''
+        INSERT into ...
+        VALUES %s
+    ;'''
+
+    def __init__(self, size=500, interval=5.0, retries=3, limit=None):
+        self.size, self.interval, self.retries = size, interval, retries
+        self.limit = limit or size * 20
+        self.written = self.flushes = self.failures = self.rejected = self.stalls = 0
+        self._rows, self._timer, self._attempts = [], None, 0
+        self._last = time.time()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, rows):
+        with self._lock:
+            self._rows.extend(rows)
+            self._schedule()
+            if len(self._rows) >= self.size or time.time() - self._last >= self.interval:
+                self.flush()
+            if len(self._rows) > self.limit:
+                self._drain()
+
+    def _drain(self):
+        """
+        Back-pressure: block the caller (and every other one, under the lock)
+        until the buffer is back within `limit`.
+        """
+        self.stalls += 1
+        logger.error('Result buffer is full (%d rows), waiting for the database.' % len(self._rows))
+        _wait = 0.1
+        while len(self._rows) > self.limit:
+            time.sleep(_wait)
+            _wait = min(_wait * 2, self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last = time.time()
+            while self._rows:
+                chunk = self._rows[:self.size]
+                try:
+                    self._insert(chunk)
+                except Exception as e:
+                    self.failures += 1
+                    self._attempts += 1
+                    logger.error('%d delivery results were not written: %s' % (len(chunk), e))
+                    if self._attempts < self.retries:
+                        return False
+                    self._attempts = 0
+                    _done = self._row_by_row(chunk)
+                    del self._rows[:_done]
+                    if _done < len(chunk):
+                        return False
+                    continue
+                self._attempts = 0
+                del self._rows[:len(chunk)]
+                self.written += len(chunk)
+                self.flushes += 1
+        return True
+
+    def _row_by_row(self, chunk):
+        """
+        Write a chunk that keeps failing one row at a time.
+        Returns number of rows dealt with (written or refused);
+        stops at the first error that is not about the row itself.
+        """
+        for _i, _row in enumerate(chunk):
+            try:
+                self._insert([_row])
+            except Exception as e:
+                if e.__class__.__name__ not in self.permanent:
+                    return _i
+                self.rejected += 1
+                logger.error('Delivery result %r was refused by the database: %s' % (_row, e))
+            else:
+                self.written += 1
+        self.flushes += 1
+        return len(chunk)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        return self.flush()
+
+    def _insert(self, chunk):
+        _values = ', '.join(['(%s)' % ', '.join(['%s'] * self.columns)] * len(chunk))
+        with pool.lease():
+            PooledDB().insert(self.sql % _values, tuple(_v for _row in chunk for _v in _row))
+
+    def _schedule(self):
+        """
+        Make sure rows left in a quiet buffer get written after `interval`.
+        """
+        if self._timer and self._timer.is_alive():
+            return
+        self._timer = threading.Timer(self.interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+
+results = ResultWriter(
+    size=getattr(settings, 'RESULT_WRITER_SIZE', 500),
+    interval=getattr(settings, 'RESULT_WRITER_INTERVAL', 5.0))
+atexit.register(results.close)
@@ -1,17 +1,53 @@
 import os
+import copy
+import json
+import time
+import timeit
+import threading
+import contextlib
 from pprint import pprint as pp
 
 class Conf(dict):
     """
     Returns default configuration for missing environments.
+
+    Nested dictionary is compiled once for the environment into a flat
+    table {path tuple: value}, defaults already resolved,
+    so every known lookup is a single dict hit.
+    Unknown paths fall back to the recursive walker (same result or KeyError).
     """
     def __init__(self, dct: dict, env: str) -> None:
         self._d = dct
         self._e = env
+        self._flat = self.compile(dct, env)
 
     def __call__(self, *args):
-        _a = args+(self._e,)
-        return self.lookup(self._d, _a)
+        try:
+            return self._flat[args]
+        except KeyError:
+            _a = args+(self._e,)
+            return self.lookup(self._d, _a)
+
+    @classmethod
+    def compile(cls, dct: dict, env: str) -> dict:
+        """
+        {('DATABASE', 'DB_HOST'): '0.0.0.0', ('DATABASE', 'DB_USER'): 'root', ...}
+        """
+        flat = {}
+        def walk(_d, path):
+            for _k, _v in _d.items():
+                if isinstance(_v, dict):
+                    walk(_v, path + (_k,))
+                else:
+                    flat[path + (_k,)] = _v
+            # all keys consumed: next one looked up is the environment
+            if path:
+                try:
+                    flat[path] = cls.lookup(_d, (env,))
+                except (KeyError, IndexError):
+                    pass
+        walk(dct, ())
+        return flat
 
     def _lookup():
         """
@@ -36,6 +72,174 @@ class Conf(dict):
     lookup = staticmethod(_lookup())
 
 
+def benchmark(depths=(1, 3, 6, 10), number=100000):
+    """
+    Recursive walker vs. flat table, per nesting depth (lookups per second).
+    """
+    results = {}
+    for depth in depths:
+        config = node = {}
+        path = tuple('LEVEL_%d' % _i for _i in range(depth))
+        for _k in path[:-1]:
+            node[_k] = node = {}
+        node[path[-1]] = {'STAGING': 'staging', 'default': 'default'}
+        conf = Conf(config, 'PRODUCTION')
+        assert conf(*path) == Conf.lookup(config, path + ('PRODUCTION',)) == 'default'
+        walker = timeit.timeit(lambda: Conf.lookup(config, path + ('PRODUCTION',)), number=number)
+        flat = timeit.timeit(lambda: conf(*path), number=number)
+        results[depth] = {'recursive': int(number / walker), 'flat': int(number / flat)}
+    return results
+
+
+class ConfigService(object):
+    """
+    Hot-reloadable configuration.
+
+    JSON source files are deep-merged in order, then environment variables
+    named `<prefix>KEY__NESTED_KEY` are laid over them (values parsed as JSON
+    when possible). A watcher thread polls file mtimes and the overlay every
+    `interval` seconds; on change a new Conf snapshot is built off the hot path
+    and swapped in with a single reference assignment, so readers never lock
+    and always see one complete snapshot.
+
+        service = ConfigService(['base.json', 'local.json'], 'STAGING').start()
+        service('DATABASE', 'DB_HOST')
+        with service.pinned() as conf:  # same snapshot for the whole request
+            conf('DATABASE', 'DB_HOST'), conf('DATABASE', 'DB_PORT')
+    """
+    def __init__(self, paths, env: str, prefix: str = 'PROJ__', interval: float = 1.0) -> None:
+        self.paths, self.env, self.prefix, self.interval = list(paths), env, prefix, interval
+        self.reloads = self.failures = 0
+        self.last_reload = self.max_reload = self.total_reload = 0.0
+        self.detected = self.swapped = 0.0
+        self.last_error = None
+        self._local = threading.local()
+        self._halt = threading.Event()
+        self._thread = None
+        self._signature = self.signature()
+        self._snapshot = self.build()
+
+    def __call__(self, *args):
+        return self.current(*args)
+
+    @property
+    def current(self) -> Conf:
+        """
+        Pinned snapshot of this thread, or the latest one.
+        """
+        _pinned = getattr(self._local, 'snapshot', None)
+        # Conf is an (empty) dict, i.e. falsy: compare with None
+        return self._snapshot if _pinned is None else _pinned
+
+    @contextlib.contextmanager
+    def pinned(self):
+        _previous = getattr(self._local, 'snapshot', None)
+        self._local.snapshot = self._snapshot if _previous is None else _previous
+        try:
+            yield self._local.snapshot
+        finally:
+            self._local.snapshot = _previous
+
+    def signature(self) -> tuple:
+        _mtimes = []
+        for _p in self.paths:
+            try:
+                _mtimes.append(os.stat(_p).st_mtime)
+            except OSError:
+                _mtimes.append(None)
+        _overlay = tuple(sorted((_k, _v) for _k, _v in os.environ.items() if _k.startswith(self.prefix)))
+        return tuple(_mtimes), _overlay
+
+    def build(self) -> Conf:
+        config = {}
+        for _p in self.paths:
+            if os.path.exists(_p):
+                with open(_p) as f:
+                    _source = json.load(f)
+                if not isinstance(_source, dict):
+                    raise ValueError('%s: top level must be an object, not %s' % (
+                        _p, type(_source).__name__))
+                self.merge(config, _source)
+        for _k, _v in self.signature()[1]:
+            node, keys = config, _k[len(self.prefix):].split('__')
+            for _n in keys[:-1]:
+                if not isinstance(node.get(_n), dict):
+                    node[_n] = {}
+                node = node[_n]
+            try:
+                node[keys[-1]] = json.loads(_v)
+            except ValueError:
+                node[keys[-1]] = _v
+        # snapshot owns its copy, nobody else can change it
+        _conf = Conf(copy.deepcopy(config), self.env)
+        _conf.version = 0
+        return _conf
+
+    @classmethod
+    def merge(cls, base: dict, other: dict) -> dict:
+        for _k, _v in other.items():
+            if isinstance(_v, dict) and isinstance(base.get(_k), dict):
+                cls.merge(base[_k], _v)
+            else:
+                base[_k] = copy.deepcopy(_v)
+        return base
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Swap in a new snapshot if any source changed. Returns True when swapped.
+        """
+        _signature = self.signature()
+        if not force and _signature == self._signature:
+            return False
+        self.detected = time.time()
+        try:
+            _snapshot = self.build()
+        except Exception as e:
+            # anything, so the watcher thread survives; keep serving the
+            # previous snapshot, see `stats()['last_error']`
+            self.failures += 1
+            self._signature = _signature
+            self.last_error = '%s' % e
+            return False
+        self.reloads += 1
+        _snapshot.version = self.reloads
+        self._snapshot, self._signature = _snapshot, _signature
+        self.swapped = time.time()
+        # change detected to new snapshot being served
+        self.last_reload = self.swapped - self.detected
+        self.max_reload = max(self.max_reload, self.last_reload)
+        self.total_reload += self.last_reload
+        self.last_error = None
+        return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name='config-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._halt.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self) -> None:
+        while not self._halt.wait(self.interval):
+            self.reload()
+
+    def stats(self) -> dict:
+        return {
+            'version': self._snapshot.version,
+            'reloads': self.reloads,
+            'failures': self.failures,
+            'last_reload': self.last_reload,
+            'max_reload': self.max_reload,
+            'avg_reload': self.reloads and self.total_reload / self.reloads or 0.0,
+            'detected': self.detected,
+            'swapped': self.swapped,
+            'last_error': self.last_error}
+
+
 def launchpad(env, config):
     """
     Configuration parameters.
@@ -92,6 +296,7 @@ if __name__ == '__main__':
     printable = ('%s=%s' % tpl for tpl in settings.items())
     print(', '.join(printable))
     pp({k: v for (k, v) in globals().items() if k.startswith('PROJ_')})
+    pp(benchmark())
 
 
 #################
@@ -1,9 +1,118 @@
 import os
+import hmac
+import hashlib
 import random
 import string
+import threading
 import time
+try:
+    import fcntl
+except ImportError:     # no advisory locks (Windows)
+    fcntl = None
  
 ########## KEY CONFIGURATION (for threaded server)
+class SecretKeyProvider(object):
+    """
+    In-memory SECRET_KEY backed by a renewable file.
+
+    File mtime is re-checked at most every `check_every` seconds, so reading
+    the key costs no I/O (`refresh()` re-checks it right away). An expired
+    key is rotated by one process only: under an advisory lock, with
+    write-to-temp-then-rename, so readers never see a truncated file. The
+    previous key stays in `random_hash.previous` and is still accepted for
+    `grace` seconds after rotation.
+    """
+    alphabet = string.ascii_letters + string.digits + string.punctuation
+
+    def __init__(self, path, max_age=86400, check_every=60, grace=300):
+        self.secret_file = os.path.join(path, 'random_hash')
+        self.previous_file = self.secret_file + '.previous'
+        self.max_age, self.check_every, self.grace = max_age, check_every, grace
+        self._key = self._previous = None
+        self._mtime = self._checked = 0
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        if self._key is None or time.time() - self._checked >= self.check_every:
+            with self._lock:
+                if self._key is None or time.time() - self._checked >= self.check_every:
+                    self._refresh()
+        return self._key
+
+    @property
+    def keys(self):
+        """
+        Keys to accept: current one, and the previous one during grace window.
+        """
+        key = self.key
+        if self._previous and time.time() - self._mtime < self.grace:
+            return key, self._previous
+        return key,
+
+    def refresh(self):
+        """
+        Re-check the file now, regardless of `check_every`, and return `keys`.
+        """
+        with self._lock:
+            self._refresh()
+        return self.keys
+
+    def _refresh(self):
+        self._checked = now = time.time()
+        try:
+            _mtime = os.stat(self.secret_file).st_mtime
+        except OSError:
+            _mtime = None
+        if _mtime is None or now - _mtime >= self.max_age:
+            self._rotate()
+        elif _mtime != self._mtime:
+            self._load()
+
+    def _rotate(self):
+        try:
+            with open(self.secret_file + '.lock', 'a') as lock:
+                fcntl and fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    _mtime = os.stat(self.secret_file).st_mtime
+                except OSError:
+                    _mtime = None
+                # somebody else may have rotated while we were waiting
+                if _mtime is None or time.time() - _mtime >= self.max_age:
+                    if _mtime is not None:
+                        self._replace(self.previous_file, self._read(self.secret_file))
+                    self._replace(self.secret_file, ''.join(
+                        random.SystemRandom().choice(self.alphabet) for c in range(32)))
+        except (OSError, IOError):
+            raise Exception('Cannot open file `%s` for writing.' % self.secret_file)
+        self._load()
+
+    def _load(self):
+        self._mtime = os.stat(self.secret_file).st_mtime
+        self._key = self._read(self.secret_file)
+        try:
+            self._previous = self._read(self.previous_file)
+        except (OSError, IOError):
+            self._previous = None
+
+    @staticmethod
+    def _read(name):
+        with open(name) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _replace(name, value):
+        _tmp = '%s.%d' % (name, os.getpid())
+        with open(_tmp, 'w') as f:
+            f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(_tmp, name)
+
+
+_providers = {}
+
+
 def secret_key_gen(path, max_age=86400):
     """
     # Try to load the SECRET_KEY from our SECRET_FILE. If that fails, then generate
@@ -12,31 +121,104 @@ def secret_key_gen(path, max_age=86400):
  
     # Absolute filesystem path to the secret file which holds this project's
     # SECRET_KEY. Will be auto-generated the first time this file is interpreted.
+
+    # Served by a cached SecretKeyProvider, one per (path, max_age).
     """
  
-    SECRET_FILE = os.path.join(path, 'random_hash')
-    try:
-        # for multiserver / distributed setup:
-        # VMs should be taken out of order in periodic fashion
- 
-        _last_modified = os.stat(SECRET_FILE).st_mtime
-        lifecycle = (time.time() - _last_modified)
+    return secret_key_provider(path, max_age).key
 
-       # update hash if file age is older than allowed
-        if (lifecycle / max_age) >= 1: raise IOError
-        SECRET_KEY = open(SECRET_FILE).read().strip()
 
-    except (OSError, IOError):
-        try:
-            with open(SECRET_FILE, 'w') as f:
-                SECRET_KEY = ''.join(
-                    random.SystemRandom().choice(string.printable) for c in range(32))
-                f.write(SECRET_KEY)
+def secret_key_provider(path, max_age=86400):
+    _key = path, max_age
+    if _key not in _providers:
+        _providers[_key] = SecretKeyProvider(path, max_age)
+    return _providers[_key]
+
+
+class BridgeSigner(object):
+    """
+    HMAC signatures for INTERNAL_BRIDGE_PROTOCOL messages, on the rotating key.
+
+    Keyed hmac objects are built once per key and `.copy()`-ed per message,
+    so no per-message key setup. Verification accepts current and previous
+    key during the rotation grace window; on a mismatch the key file is
+    re-checked once, so a receiver doesn't reject messages signed with a key
+    another process has just rotated in.
+    """
+    def __init__(self, provider, digestmod=hashlib.sha256):
+        self.provider, self.digestmod = provider, digestmod
+        self._keyed = {}
+
+    def _macs(self, keys):
+        # local reference: a concurrent call with other keys may swap `_keyed`
+        keyed = self._keyed
+        if any(_k not in keyed for _k in keys):
+            keyed = {_k: keyed.get(_k) or hmac.new(
+                _k.encode('utf-8'), digestmod=self.digestmod) for _k in keys}
+            self._keyed = keyed
+        return [keyed[_k] for _k in keys]
+
+    @staticmethod
+    def _digest(mac, message):
+        mac = mac.copy()
+        mac.update(message if isinstance(message, bytes) else message.encode('utf-8'))
+        return mac.hexdigest()
+
+    def sign(self, message):
+        return self._digest(self._macs((self.provider.key,))[0], message)
+
+    def verify(self, message, signature):
+        return self.verify_many([(message, signature)])[0]
+
+    def verify_many(self, messages):
+        """
+        [(message, signature), ...] -> [bool, ...]
+        Keys and keyed hmacs are looked up once for the whole batch.
+        """
+        keys = self.provider.keys
+        macs, verified = self._macs(keys), []
+        for message, signature in messages:
+            if not isinstance(message, bytes):
+                message = message.encode('utf-8')
+            verified.append(self._match(macs, message, signature))
+        if not all(verified):
+            # the key may have been rotated by another process since our last check
+            _keys = self.provider.refresh()
+            if _keys != keys:
+                macs = self._macs(_keys)
+                for _i, (message, signature) in enumerate(messages):
+                    if not verified[_i]:
+                        if not isinstance(message, bytes):
+                            message = message.encode('utf-8')
+                        verified[_i] = self._match(macs, message, signature)
+        return verified
 
-        except IOError:
-            raise Exception('Cannot open file `%s` for writing.' % SECRET_FILE)
+    @staticmethod
+    def _match(macs, message, signature):
+        for _m in macs:
+            _c = _m.copy()
+            _c.update(message)
+            if hmac.compare_digest(_c.hexdigest(), signature):
+                return True
+        return False
 
-    return SECRET_KEY
+
+def benchmark(signer, n=100000, size=256):
+    """
+    Verifications per second: rekeying per message vs. copying keyed hmac.
+    """
+    key, message = signer.provider.key.encode('utf-8'), b'x' * size
+    batch = [(message, signer.sign(message))] * n
+
+    started = time.time()
+    for _m, _s in batch:
+        hmac.compare_digest(hmac.new(key, _m, signer.digestmod).hexdigest(), _s)
+    rekeyed = n / (time.time() - started)
+
+    started = time.time()
+    assert all(signer.verify_many(batch))
+    copied = n / (time.time() - started)
+    return {'rekeyed_per_sec': int(rekeyed), 'copied_per_sec': int(copied)}
 
  
  
@@ -48,7 +230,16 @@ INTERNAL_BRIDGE_PROTOCOL = {
     'hash': secret_key_gen(
         path=os.path.dirname(__file__),
         max_age=60 * 60 * 24),      # a day
+
+    # sign inside senders and verify on receivers
+    'signer': BridgeSigner(secret_key_provider(
+        path=os.path.dirname(__file__),
+        max_age=60 * 60 * 24)),
     # 'hash': ''.join(random.SystemRandom().choice(
     #     string.printable) for _ in range(32))
 }
- 
\ No newline at end of file
+ 
+
+
+if __name__ == '__main__':
+    print(benchmark(INTERNAL_BRIDGE_PROTOCOL['signer']))
@@ -0,0 +1,197 @@
+"""
+Pure-Python boot for wsgi.py: no bash subprocesses, no execfile.
+
+Picks the virtualenv by reading /sys/hypervisor/uuid, parses
+.environment_variables directly and caches the result (venv path, env vars)
+in a JSON manifest keyed by mtimes of the files it was resolved from and
+by the inherited environment variables the env file depends on.
+Timing breakdown of every step goes to stderr.
+"""
+import os
+import re
+import sys
+import json
+import site
+import time
+
+
+HYPERVISOR_UUID = '/sys/hypervisor/uuid'
+
+# virtualenv on EC2 and on devserver is named differently.
+EC2_VIRTUALENV = '/.virtualenvs/...A'
+OTHER_VIRTUALENV = '/.virtualenv/...B'  # TODO: recreate local virtualenv as `...A or ...B`
+
+_assignment = re.compile(r'^\s*(export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$')
+_reference = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+
+class Timings(object):
+    def __init__(self):
+        self.steps, self._t = [], time.time()
+
+    def __call__(self, step):
+        _now = time.time()
+        self.steps.append((step, _now - self._t))
+        self._t = _now
+
+    def __str__(self):
+        _l = ['%-12s %8.2f ms' % (_s, _d * 1000) for _s, _d in self.steps]
+        _l.append('%-12s %8.2f ms' % ('total', sum(_d for _, _d in self.steps) * 1000))
+        return '\n'.join(_l)
+
+
+def is_ec2(path=HYPERVISOR_UUID):
+    try:
+        with open(path) as f:
+            return f.read(3) == 'ec2'
+    except (IOError, OSError):
+        return False
+
+
+def _expand(value, scope, depends):
+    """
+    $NAME and ${NAME}: assigned earlier in the file, else inherited, else ''.
+    """
+    def _value(_m):
+        _name = _m.group(1) or _m.group(2)
+        if _name in scope:
+            return scope[_name]
+        depends[_name] = os.environ.get(_name)
+        return os.environ.get(_name, '')
+    return _reference.sub(_value, value)
+
+
+def _unquote(value, scope, depends):
+    value = value.strip()
+    if value[:1] == "'":
+        _end = value.find("'", 1)
+        return value[1:_end > 0 and _end or None]
+    if value[:1] == '"':
+        _end = 1
+        while _end < len(value) and (value[_end] != '"' or value[_end - 1] == '\\'):
+            _end += 1
+        return _expand(re.sub(r'\\(["\\$`])', r'\1', value[1:_end]), scope, depends)
+    # unquoted: value ends at the first blank or comment
+    return _expand(re.split(r'\s+#|\s', value, 1)[0], scope, depends)
+
+
+def parse_env_file(path, match='SERVER', depends=None):
+    """
+    Same result as `source <path> && env | grep SERVER`: exported assignments
+    (and updates of already exported variables) whose line contains `match`.
+    References expand against the file's own earlier assignments first, then
+    the inherited environment; inherited variables the result depends on are
+    recorded in `depends`.
+    """
+    found, scope, exports = {}, {}, set()
+    depends = {} if depends is None else depends
+    with open(path) as f:
+        for line in f:
+            _m = _assignment.match(line)
+            if _m is None:
+                continue
+            exported, key, value = _m.groups()
+            scope[key] = value = _unquote(value, scope, depends)
+            if not exported and key not in exports:
+                depends[key] = os.environ.get(key)
+                if key not in os.environ:
+                    continue
+            exports.add(key)
+            if match in '%s=%s' % (key, value):
+                found[key] = value
+            else:
+                found.pop(key, None)
+    return found
+
+
+def _mtimes(paths):
+    _r = {}
+    for _p in paths:
+        try:
+            _r[_p] = os.stat(_p).st_mtime
+        except OSError:
+            _r[_p] = None
+    return _r
+
+
+def resolve(homepath, env_file, manifest=None, timings=None):
+    """
+    {'virtualenv': ..., 'environ': {...}}, from the manifest when it is still
+    fresh, otherwise resolved again and saved.
+    """
+    timings = timings or Timings()
+    key = _mtimes((HYPERVISOR_UUID, env_file))
+    if manifest and os.path.exists(manifest):
+        try:
+            with open(manifest) as f:
+                cached = json.load(f)
+            _fresh = cached.get('key') == key and cached.get('homepath') == homepath
+            if _fresh and all(os.environ.get(_k) == _v for _k, _v in cached['depends'].items()):
+                timings('manifest')
+                return cached
+        except (IOError, ValueError, KeyError):
+            pass
+    timings('manifest')
+
+    virtualenv = homepath + (is_ec2() and EC2_VIRTUALENV or OTHER_VIRTUALENV)
+    timings('hypervisor')
+    depends = {}
+    environ = os.path.exists(env_file) and parse_env_file(env_file, depends=depends) or {}
+    timings('env file')
+
+    resolved = dict(
+        key=key, homepath=homepath, virtualenv=virtualenv, environ=environ, depends=depends)
+    if manifest:
+        _tmp = '%s.%d' % (manifest, os.getpid())
+        try:
+            # holds the SERVER* values (credentials included): owner only
+            with os.fdopen(os.open(_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(resolved, f)
+            os.rename(_tmp, manifest)
+        except (IOError, OSError) as e:
+            sys.stderr.write('Boot manifest %s was not saved: %s\n' % (manifest, e))
+        timings('save')
+    return resolved
+
+
+def activate(virtualenv):
+    """
+    Same as activate_this.py, on Python 2 and 3 (venv ships no activate_this.py).
+    """
+    activate_this = os.path.join(virtualenv, 'bin', 'activate_this.py')
+    if os.path.exists(activate_this):
+        with open(activate_this) as f:
+            exec(compile(f.read(), activate_this, 'exec'), {'__file__': activate_this})
+        return
+    os.environ['VIRTUAL_ENV'] = virtualenv
+    os.environ['PATH'] = os.path.join(virtualenv, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    _before = list(sys.path)
+    site.addsitedir(site_packages(virtualenv))
+    # virtualenv packages go first, as with activate_this.py
+    sys.path[:] = [_p for _p in sys.path if _p not in _before] + _before
+    sys.prefix = virtualenv
+
+
+def site_packages(virtualenv):
+    return os.path.join(virtualenv, 'lib', 'python%d.%d' % sys.version_info[:2], 'site-packages')
+
+
+def boot(homepath, pwd, env_file='.environment_variables', manifest='.boot_manifest.json',
+         verbose=True):
+    timings = Timings()
+    resolved = resolve(
+        homepath, os.path.join(pwd, env_file), manifest and os.path.join(pwd, manifest), timings)
+
+    # Add the site-packages of the chosen virtualenv to work with
+    site.addsitedir(site_packages(resolved['virtualenv']))
+    timings('site')
+
+    os.environ.update(resolved['environ'])
+    timings('environ')
+
+    activate(resolved['virtualenv'])
+    timings('activate')
+
+    if verbose:
+        sys.stderr.write('wsgi boot (pid %d):\n%s\n' % (os.getpid(), timings))
+    return resolved
@@ -0,0 +1,231 @@
+"""
+Pre-fork launcher for wsgi.py.
+
+The master boots the environment and imports the application once, moves
+everything it allocated out of the garbage collector's reach (`gc.freeze()`,
+Python 3.7+) and forks workers that accept on one shared listening socket,
+so Django and the module heap stay shared copy-on-write between them.
+Crashed workers are respawned. Per-worker RSS / shared / private memory is
+reported on SIGUSR1 and every `--report` seconds.
+
+Workers serve requests in threads and drain them on SIGTERM (the master
+SIGKILLs whatever is left after `--graceful` seconds). The HTTP side is
+still wsgiref: HTTP/1.0, one request per connection, no keep-alive;
+keep a reverse proxy (nginx) in front of it in production.
+
+    python wsgi_prefork.py --bind 0.0.0.0:8000 --workers 8
+"""
+import os
+import gc
+import sys
+import time
+import socket
+import signal
+import argparse
+import importlib
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+
+def load(target):
+    """
+    'module:attribute' -> WSGI application, imported in the master only.
+    """
+    module, _, attribute = target.partition(':')
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    # no collections while the whole app is being imported, freeze it afterwards
+    gc.disable()
+    try:
+        application = getattr(importlib.import_module(module), attribute or 'application')
+    finally:
+        gc.enable()
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    return application
+
+
+def listen(bind, backlog=128):
+    host, _, port = bind.rpartition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host or '0.0.0.0', int(port)))
+    sock.listen(backlog)
+    return sock
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    # server_close() joins the request threads (and only those)
+    daemon_threads = False
+    block_on_close = True
+
+    if not hasattr(socketserver.ThreadingMixIn, 'block_on_close'):
+        # Python < 3.7: ThreadingMixIn doesn't keep its threads, track them here
+        def process_request(self, request, client_address):
+            _t = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+            _t.daemon = self.daemon_threads
+            self._requests = [_r for _r in getattr(self, '_requests', ()) if _r.is_alive()] + [_t]
+            _t.start()
+
+        def server_close(self):
+            WSGIServer.server_close(self)
+            for _t in getattr(self, '_requests', ()):
+                _t.join()
+
+
+def serve(sock, application, quiet=False):
+    """
+    Threaded wsgiref server on an already bound socket.
+    SIGTERM stops accepting and waits for requests in flight.
+    """
+    httpd = ThreadingWSGIServer(sock.getsockname(), quiet and QuietHandler or WSGIRequestHandler,
+                                bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    httpd.server_address = sock.getsockname()
+    httpd.server_name = socket.getfqdn(httpd.server_address[0])
+    httpd.server_port = httpd.server_address[1]
+    httpd.setup_environ()
+    httpd.set_app(application)
+    # shutdown() waits for serve_forever(): call it from another thread
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=httpd.shutdown).start())
+    httpd.serve_forever()
+    # waits for requests in flight, not for threads the application started
+    httpd.server_close()
+
+
+def memory(pid):
+    """
+    {'rss': ..., 'shared': ..., 'private': ..., 'pss': ...} in KiB.
+    smaps_rollup (Linux 4.14+), statm otherwise (no private / pss).
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            _r = {}
+            for line in f:
+                _p = line.split()
+                if len(_p) == 3 and _p[2] == 'kB':
+                    _r[_p[0].rstrip(':')] = int(_p[1])
+        return dict(
+            rss=_r.get('Rss', 0), pss=_r.get('Pss', 0),
+            shared=_r.get('Shared_Clean', 0) + _r.get('Shared_Dirty', 0),
+            private=_r.get('Private_Clean', 0) + _r.get('Private_Dirty', 0))
+    except (IOError, OSError):
+        pass
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            _s = [int(_v) for _v in f.read().split()]
+        _page = os.sysconf('SC_PAGE_SIZE') // 1024
+        return dict(rss=_s[1] * _page, shared=_s[2] * _page, private=(_s[1] - _s[2]) * _page, pss=None)
+    except (IOError, OSError, ValueError, IndexError):
+        return {}
+
+
+class Master(object):
+    """
+    Forks `workers` processes serving `application` on `sock`,
+    replaces every one that exits until stopped.
+    """
+    def __init__(self, application, sock, workers=4, quiet=False, report=0, graceful=30):
+        self.application, self.sock, self.workers = application, sock, workers
+        self.quiet, self.report_every, self.graceful = quiet, report, graceful
+        self.children = {}  # pid: started
+        self.respawned = 0
+        self._stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        # worker: Ctrl-C reaches the whole group, the master turns it into SIGTERM
+        for _s in (signal.SIGINT, signal.SIGUSR1):
+            signal.signal(_s, signal.SIG_IGN)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        signal.alarm(0)
+        try:
+            serve(self.sock, self.application, self.quiet)
+        except Exception as e:
+            sys.stderr.write('Worker %d failed: %s\n' % (os.getpid(), e))
+            os._exit(1)
+        os._exit(0)
+
+    def stop(self, *args):
+        if self._stopping:
+            return
+        self._stopping = True
+        # workers drain their requests; whatever is left gets killed
+        signal.signal(signal.SIGALRM, self.kill)
+        signal.alarm(self.graceful)
+        self.signal(signal.SIGTERM)
+
+    def kill(self, *args):
+        self.signal(signal.SIGKILL)
+
+    def signal(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def report(self, *args):
+        _l = ['%8s %10s %11s %12s %10s' % ('pid', 'rss KiB', 'shared KiB', 'private KiB', 'pss KiB')]
+        for pid in [os.getpid()] + sorted(self.children):
+            _m = memory(pid)
+            _l.append('%8d %10s %11s %12s %10s' % (
+                pid, _m.get('rss'), _m.get('shared'), _m.get('private'), _m.get('pss')))
+        sys.stderr.write('\n'.join(_l) + '\n')
+        if self.report_every and not self._stopping:
+            signal.alarm(self.report_every)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.report)
+        signal.signal(signal.SIGALRM, self.report)
+        for _ in range(self.workers):
+            self.spawn()
+        if self.report_every:
+            signal.alarm(self.report_every)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                # interrupted by a signal (Python 2)
+                continue
+            started = self.children.pop(pid, None)
+            if self._stopping or started is None:
+                continue
+            sys.stderr.write('Worker %d exited with status %d, respawning.\n' % (pid, status))
+            # don't spin when workers die right away
+            if time.time() - started < 1:
+                time.sleep(1)
+            self.respawned += 1
+            self.spawn()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-fork wsgiref server for wsgi.py.')
+    parser.add_argument('--app', default='wsgi:application', help='module:attribute')
+    parser.add_argument('--bind', default='127.0.0.1:8000')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--report', type=int, default=0, help='memory report every N seconds')
+    parser.add_argument('--quiet', action='store_true', help='no access log')
+    parser.add_argument('--graceful', type=int, default=30,
+                        help='seconds workers get to finish requests on shutdown')
+    _a = parser.parse_args()
+
+    _started = time.time()
+    _application = load(_a.app)
+    sys.stderr.write('%s loaded in %.2f s\n' % (_a.app, time.time() - _started))
+    Master(_application, listen(_a.bind), _a.workers, _a.quiet, _a.report, _a.graceful).run()